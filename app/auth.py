@@ -3,85 +3,70 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-import os
-from dotenv import load_dotenv
+from .config import get_settings
 from .utils import get_logger
 
 logger = get_logger(__name__)
 
-# Load environment variables
-load_dotenv(override=True)
-
-SECRET_KEY = os.getenv('SECRET_KEY')
-ALGORITHM = os.getenv('ALGORITHM')
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv('ACCESS_TOKEN_EXPIRE_MINUTES'))
+# Settings (SECRET_KEY, ALGORITHM, admin credentials) are read from the
+# environment / .env on first use and checked at application startup.
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Read admin credentials from .env file
-ADMIN_USERNAME = os.getenv('ADMIN_USERNAME')
-ADMIN_PASSWORD_HASH = os.getenv('ADMIN_PASSWORD_HASH')
-
-
-# print(f"ADMIN_USERNAME: '{ADMIN_USERNAME}'")
-# print(f"ADMIN_PASSWORD_HASH: '{ADMIN_PASSWORD_HASH}'")
-
-# Check if environment variables are loaded
-if not all([SECRET_KEY, ALGORITHM, ADMIN_USERNAME, ADMIN_PASSWORD_HASH]):
-    logger.error("Environment variables not properly loaded. Check your .env file.")
-    raise Exception("Environment variables not properly loaded.")
-
 router = APIRouter()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def authenticate_user(username: str, password: str):
-    logger.info(f"Authenticating user: {username}")
+    settings = get_settings()
+    logger.debug("Authenticating user: %s", username)
 
-    if username != ADMIN_USERNAME:
+    if username != settings.admin_username:
         logger.warning("Username does not match ADMIN_USERNAME")
         return None
-    if not verify_password(password, ADMIN_PASSWORD_HASH):
+    if not verify_password(password, settings.admin_password_hash):
         logger.warning("Password verification failed")
         return None
-    logger.info("Authentication successful")
-    return {"username": ADMIN_USERNAME}
+    logger.debug("Authentication successful")
+    return {"username": settings.admin_username}
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
     to_encode.update({"exp": expire, "sub": data.get("sub")})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    settings = get_settings()
+    return jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
     )
+    settings = get_settings()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
         username: str = payload.get("sub")
-        if username != ADMIN_USERNAME:
+        if username != settings.admin_username:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    return {"username": ADMIN_USERNAME}
+    return {"username": settings.admin_username}
 
 @router.post("/token")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     user = authenticate_user(form_data.username, form_data.password)
     if not user:
-        logger.warning(f"Failed login attempt for user {form_data.username}")
+        logger.warning("Failed login attempt for user %s", form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token_expires = timedelta(minutes=get_settings().access_token_expire_minutes)
     access_token = create_access_token(
         data={"sub": user["username"]}, expires_delta=access_token_expires
     )
-    logger.info(f"User {user['username']} logged in.")
+    logger.info("User %s logged in.", user['username'])
     return {"access_token": access_token, "token_type": "bearer"}
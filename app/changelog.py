@@ -0,0 +1,235 @@
+# app/changelog.py
+
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func, insert
+from sqlalchemy.orm import Session, selectinload
+
+from . import models, schemas
+from .auth import get_current_user
+from .database import get_db
+
+class ChangeLog:
+    """
+    Change log kept in the User_Changes table. Writers add their changed user
+    ids in the same transaction as the writes, so once committed they are
+    visible to feeds in every process. Feeds poll the table; writers in this
+    process also wake them up right away.
+    """
+
+    def __init__(self, retention: Optional[int] = None, poll_interval: Optional[float] = None,
+                 gap_timeout: Optional[float] = None):
+        self.retention = retention or int(os.getenv("FEED_RETENTION", "100000"))
+        self.poll_interval = poll_interval or float(os.getenv("FEED_POLL_INTERVAL", "1"))
+        self.gap_timeout = gap_timeout or float(os.getenv("FEED_GAP_TIMEOUT", "10"))
+        self._lock = threading.Lock()
+        self._waiters = set()
+
+    def record(self, db: Session, user_ids):
+        """
+        Adds changed user ids to the current transaction and drops entries past
+        the retention. Does not commit.
+        """
+        rows = [{"userId": user_id} for user_id in user_ids]
+        if not rows:
+            return
+        db.execute(insert(models.UserChange), rows)
+        oldest = self.latest(db) - self.retention
+        db.execute(delete(models.UserChange).where(models.UserChange.version <= oldest))
+
+    def notify(self):
+        """
+        Wakes up the feeds of this process after a commit. Safe to call from
+        worker threads.
+        """
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiting loop has already shut down
+                pass
+
+    def latest(self, db: Session) -> int:
+        return db.query(func.max(models.UserChange.version)).scalar() or 0
+
+    def since(self, db: Session, version: int, limit: int = 1000):
+        """
+        Returns (up to limit entries newer than version, reset). reset is True
+        when the version is unknown or already trimmed, and the client has to
+        reload.
+        """
+        latest = self.latest(db)
+        if version > latest or version < latest - self.retention:
+            return [], True
+        rows = (
+            db.query(models.UserChange.version, models.UserChange.userId)
+            .filter(models.UserChange.version > version)
+            .order_by(models.UserChange.version)
+            .limit(limit)
+            .all()
+        )
+        return [tuple(row) for row in rows], False
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Waits until a writer in this process calls notify, or for timeout.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+changelog = ChangeLog()
+
+def _sse(event: str, version: int, data: str = "") -> str:
+    return f"id: {version}\nevent: {event}\ndata: {data}\n\n"
+
+def _user_events(db: Session, entries, start_time, end_time):
+    """
+    Loads the users of a batch of changelog entries and renders their events.
+    Blocking, so feed_events runs it in the threadpool.
+    """
+    latest = {}
+    for entry_version, user_id in entries:
+        latest[user_id] = entry_version
+    query = (
+        db.query(models.User)
+        .options(selectinload(models.User.phones), selectinload(models.User.voicemails))
+        .filter(models.User.id.in_(latest))
+    )
+    if start_time is not None:
+        query = query.filter(models.User.originationTime >= start_time)
+    if end_time is not None:
+        query = query.filter(models.User.originationTime <= end_time)
+    try:
+        users = sorted(query.all(), key=lambda u: latest[u.id])
+        events = []
+        for user in users:
+            user.phones.sort(key=lambda p: p.identifier)
+            user.voicemails.sort(key=lambda v: v.identifier)
+            events.append(_sse("user", latest[user.id], schemas.User.model_validate(user).model_dump_json()))
+        return events
+    finally:
+        # Hand the connection back to the pool while idle
+        db.rollback()
+
+def _read_changes(log: ChangeLog, db: Session, version: Optional[int]):
+    """
+    Returns (latest version, entries after version, reset). Blocking, so
+    feed_events runs it in the threadpool.
+    """
+    try:
+        if version is None:
+            return log.latest(db), [], False
+        entries, reset = log.since(db, version)
+        return (log.latest(db) if reset else version), entries, reset
+    finally:
+        # End the read transaction, so the next poll sees newer commits
+        db.rollback()
+
+def _contiguous(entries, version):
+    """
+    Leading entries that directly follow version.
+    """
+    run = []
+    for entry in entries:
+        if entry[0] != version + 1:
+            break
+        run.append(entry)
+        version = entry[0]
+    return run
+
+async def feed_events(
+    log: ChangeLog,
+    db: Session,
+    since: Optional[int],
+    start_time: Optional[int] = None,
+    end_time: Optional[int] = None,
+    is_disconnected=None,
+    heartbeat: float = 15.0,
+):
+    """
+    Yields Server-Sent Events for users changed after `since`, then keeps
+    streaming new changes as they are committed.
+    """
+    version = since
+    if version is None:
+        version, _, _ = await run_in_threadpool(_read_changes, log, db, None)
+    yield _sse("ready", version)
+
+    last_sent = time.monotonic()
+    gap_seen = None
+    while True:
+        latest, entries, reset = await run_in_threadpool(_read_changes, log, db, version)
+        if reset:
+            # Too far behind (or from another database): the client must refetch
+            version = latest
+            yield _sse("reset", version)
+            last_sent = time.monotonic()
+            continue
+
+        batch = _contiguous(entries, version)
+        if entries and not batch:
+            # A lower version may belong to a transaction that has not committed yet;
+            # skip the gap only once it has been open for gap_timeout (e.g. a rollback)
+            gap_seen = gap_seen or time.monotonic()
+            if time.monotonic() - gap_seen >= log.gap_timeout:
+                batch = _contiguous(entries, entries[0][0] - 1)
+        if batch:
+            gap_seen = None
+            for event in await run_in_threadpool(_user_events, db, batch, start_time, end_time):
+                yield event
+            version = batch[-1][0]
+            last_sent = time.monotonic()
+            continue
+
+        if is_disconnected is not None and await is_disconnected():
+            return
+        if time.monotonic() - last_sent >= heartbeat:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        await log.wait(min(log.poll_interval, heartbeat))
+
+router = APIRouter(tags=["feed"])
+
+@router.get("/users/feed")
+async def users_feed(
+    request: Request,
+    since: Optional[int] = Query(None, description="Version to stream changes after"),
+    start_time: Optional[int] = Query(None, description="Only users at or after this Unix timestamp"),
+    end_time: Optional[int] = Query(None, description="Only users at or before this Unix timestamp"),
+    last_event_id: Optional[int] = Header(None),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    if start_time is not None and end_time is not None and start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start_time must be less than end_time")
+
+    # Browsers resend the last event id when they reconnect; backfill from there
+    if last_event_id is not None:
+        since = last_event_id
+
+    events = feed_events(changelog, db, since, start_time, end_time, request.is_disconnected)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,55 @@
+# app/config.py
+
+import os
+import threading
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+_env_lock = threading.Lock()
+_env_loaded = False
+
+def load_env():
+    """
+    Reads .env into the environment once per process. Values in .env win over
+    the inherited environment.
+    """
+    global _env_loaded
+    with _env_lock:
+        if not _env_loaded:
+            load_dotenv(override=True)
+            _env_loaded = True
+
+def _optional_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+class Settings:
+    def __init__(self):
+        self.database_url = os.getenv("DATABASE_URL")
+        self.secret_key = os.getenv("SECRET_KEY")
+        self.algorithm = os.getenv("ALGORITHM")
+        self.access_token_expire_minutes = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES") or 30)
+        self.admin_username = os.getenv("ADMIN_USERNAME")
+        self.admin_password_hash = os.getenv("ADMIN_PASSWORD_HASH")
+        self.auto_create_schema = os.getenv("AUTO_CREATE_SCHEMA", "").lower() in ("1", "true", "yes")
+        # Per-process pool limits; app.server sets them from DB_MAX_CONNECTIONS for each worker
+        self.db_pool_size = _optional_int("DB_POOL_SIZE")
+        self.db_max_overflow = _optional_int("DB_MAX_OVERFLOW")
+
+    def validate(self):
+        required = {
+            "DATABASE_URL": self.database_url,
+            "SECRET_KEY": self.secret_key,
+            "ALGORITHM": self.algorithm,
+            "ADMIN_USERNAME": self.admin_username,
+            "ADMIN_PASSWORD_HASH": self.admin_password_hash,
+        }
+        missing = [name for name, value in required.items() if not value]
+        if missing:
+            raise Exception(f"Environment variables not properly loaded: {', '.join(missing)}")
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    load_env()
+    return Settings()
@@ -0,0 +1,356 @@
+# app/crud.py
+
+from bisect import bisect_left, bisect_right
+from typing import List, Optional
+from fastapi import HTTPException, Query
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.orm import Session, load_only, raiseload, selectinload
+
+from . import models, schemas
+
+DAY = 24 * 60 * 60
+
+USER_COLUMNS = ("id", "userId", "originationTime", "clusterId")
+USER_RELATIONSHIPS = ("phones", "voicemails")
+USER_FIELDS = USER_COLUMNS + USER_RELATIONSHIPS
+
+# Dependency parsing the optional comma-separated `fields` projection
+def get_user_fields(
+    fields: Optional[str] = Query(None, description="Comma-separated subset of: " + ", ".join(USER_FIELDS))
+):
+    if fields is None:
+        return None
+    requested = []
+    for field in fields.split(","):
+        field = field.strip()
+        if field not in USER_FIELDS:
+            raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
+        if field not in requested:
+            requested.append(field)
+    if not requested:
+        raise HTTPException(status_code=400, detail="fields must not be empty")
+    return requested
+
+# Dependency collecting the optional filters shared by /users/ and downloads
+def get_user_filters(
+    cluster_id: Optional[List[str]] = Query(None, description="Only these clusters (repeatable)"),
+    user_id_prefix: Optional[str] = Query(None, description="userId starts with this"),
+    phone: Optional[str] = Query(None, description="Exact phone identifier"),
+    phone_prefix: Optional[str] = Query(None, description="Phone identifier starts with this"),
+    voicemail: Optional[str] = Query(None, description="Exact voicemail identifier"),
+    voicemail_prefix: Optional[str] = Query(None, description="Voicemail identifier starts with this"),
+):
+    return schemas.UserFilters(
+        cluster_id=cluster_id,
+        user_id_prefix=user_id_prefix,
+        phone=phone,
+        phone_prefix=phone_prefix,
+        voicemail=voicemail,
+        voicemail_prefix=voicemail_prefix,
+    )
+
+def _device_user_ids(link, device, key, exact, prefix):
+    # Resolve identifiers through the unique index, then the link table's device index
+    subquery = select(link.userId).join(device, getattr(device, key) == getattr(link, key))
+    if exact is not None:
+        subquery = subquery.where(device.identifier == exact)
+    if prefix is not None:
+        subquery = subquery.where(device.identifier.startswith(prefix, autoescape=True))
+    return subquery
+
+def apply_user_filters(query, filters: Optional[schemas.UserFilters]):
+    if filters is None:
+        return query
+    if filters.cluster_id:
+        query = query.filter(models.User.clusterId.in_(filters.cluster_id))
+    if filters.user_id_prefix:
+        query = query.filter(models.User.userId.startswith(filters.user_id_prefix, autoescape=True))
+    if filters.phone is not None or filters.phone_prefix:
+        query = query.filter(models.User.id.in_(_device_user_ids(
+            models.UserPhones, models.Phone, "phoneId",
+            filters.phone, filters.phone_prefix or None
+        )))
+    if filters.voicemail is not None or filters.voicemail_prefix:
+        query = query.filter(models.User.id.in_(_device_user_ids(
+            models.UserVoicemails, models.Voicemail, "vmId",
+            filters.voicemail, filters.voicemail_prefix or None
+        )))
+    return query
+
+# The expression users are ordered by for a `parameter`, before the id tiebreaker
+def order_expression(parameter: Optional[str]):
+    if parameter == 'user_id':
+        return models.User.userId
+    if parameter == 'phone':
+        return func.min(models.Phone.identifier)
+    if parameter == 'voicemail':
+        return func.min(models.Voicemail.identifier)
+    if parameter == 'cluster':
+        return models.User.clusterId
+    return None
+
+# Build the ordered users query shared by the API, CSV download and exports
+def build_users_query(
+    start_time: int,
+    end_time: int,
+    parameter: Optional[str],
+    db: Session,
+    filters: Optional[schemas.UserFilters] = None
+):
+    query = db.query(models.User).filter(
+        models.User.originationTime.between(start_time, end_time)
+    )
+    query = apply_user_filters(query, filters)
+    return _order_users(query, parameter)
+
+def _order_users(query, parameter: Optional[str]):
+    if parameter == 'phone':
+        # Order users by the minimum phone identifier
+        query = query.outerjoin(models.User.phones).group_by(models.User.id)
+    elif parameter == 'voicemail':
+        # Order users by the minimum voicemail identifier
+        query = query.outerjoin(models.User.voicemails).group_by(models.User.id)
+    expression = order_expression(parameter)
+    if expression is not None:
+        query = query.order_by(expression.asc())
+
+    # Break ties on the primary key so chunked reads are deterministic
+    return query.order_by(models.User.id)
+
+def _sort_devices(users):
+    for user in users:
+        user.phones.sort(key=lambda p: p.identifier)
+        user.voicemails.sort(key=lambda v: v.identifier)
+    return users
+
+# Helper function to fetch users with ordering
+def fetch_users(
+    start_time: int,
+    end_time: int,
+    parameter: Optional[str],
+    db: Session,
+    limit: Optional[int] = None,
+    filters: Optional[schemas.UserFilters] = None,
+    fields: Optional[List[str]] = None
+):
+    query = build_users_query(start_time, end_time, parameter, db, filters)
+    if limit is not None:
+        query = query.limit(limit)
+
+    if fields is not None:
+        return project_users(query, fields)
+
+    users = query.options(
+        selectinload(models.User.phones), selectinload(models.User.voicemails)
+    ).all()
+
+    # Sort phones and voicemails for each user
+    return _sort_devices(users)
+
+def fetch_users_after(
+    start_time: int,
+    end_time: int,
+    parameter: Optional[str],
+    db: Session,
+    after: Optional[list],
+    limit: int,
+    filters: Optional[schemas.UserFilters] = None
+):
+    """
+    Keyset page of the fetch_users order: the next `limit` users after the
+    [order value, id] key `after` (None for the first page). Returns the users
+    and the key of the last one, so each page costs the same however deep it is.
+    """
+    query = build_users_query(start_time, end_time, parameter, db, filters)
+    expression = order_expression(parameter)
+
+    if after is not None:
+        value, last_id = after
+        if expression is None:
+            condition = models.User.id > last_id
+        elif value is None:
+            # NULLs sort first: the rest of the NULLs, then every non-NULL value
+            condition = or_(and_(expression.is_(None), models.User.id > last_id), expression.isnot(None))
+        else:
+            condition = or_(expression > value, and_(expression == value, models.User.id > last_id))
+        # The device orders are aggregates, so they are compared after grouping
+        query = query.having(condition) if parameter in ('phone', 'voicemail') else query.filter(condition)
+
+    if expression is not None:
+        query = query.add_columns(expression)
+    rows = query.options(
+        selectinload(models.User.phones), selectinload(models.User.voicemails)
+    ).limit(limit).all()
+
+    if expression is None:
+        users = rows
+        last_key = [None, users[-1].id] if users else after
+    else:
+        users = [user for user, _ in rows]
+        last_key = [rows[-1][1], users[-1].id] if rows else after
+    return _sort_devices(users), last_key
+
+def _relationship_options(relationships):
+    # Load requested device lists (identifiers only); refuse to lazy-load the rest
+    options = []
+    if "phones" in relationships:
+        options.append(selectinload(models.User.phones).load_only(models.Phone.identifier))
+    else:
+        options.append(raiseload(models.User.phones))
+    if "voicemails" in relationships:
+        options.append(selectinload(models.User.voicemails).load_only(models.Voicemail.identifier))
+    else:
+        options.append(raiseload(models.User.voicemails))
+    return options
+
+def _project_row(user, fields: List[str]):
+    row = {f: getattr(user, f) for f in fields if f in USER_COLUMNS}
+    if "phones" in fields:
+        row["phones"] = [
+            {"identifier": p.identifier, "phoneId": p.phoneId}
+            for p in sorted(user.phones, key=lambda p: p.identifier)
+        ]
+    if "voicemails" in fields:
+        row["voicemails"] = [
+            {"identifier": v.identifier, "vmId": v.vmId}
+            for v in sorted(user.voicemails, key=lambda v: v.identifier)
+        ]
+    return row
+
+# Load only the requested fields of each user, as dicts
+def project_users(query, fields: List[str]):
+    columns = [getattr(models.User, f) for f in fields if f in USER_COLUMNS]
+    relationships = [f for f in fields if f in USER_RELATIONSHIPS]
+
+    if not relationships:
+        # Plain column select: no ORM objects and no device tables
+        return [row._asdict() for row in query.with_entities(*columns)]
+
+    options = [load_only(*(columns or [models.User.id]))] + _relationship_options(relationships)
+    return [_project_row(user, fields) for user in query.options(*options)]
+
+def _window_ranks(db: Session, condition, parameter: str, filters: Optional[schemas.UserFilters]):
+    """
+    Position of each scanned user in build_users_query's order for parameter.
+    The database sorts, so its collation applies just as it does for /users/.
+    """
+    query = _order_users(apply_user_filters(db.query(models.User.id).filter(condition), filters), parameter)
+    return {user_id: rank for rank, (user_id,) in enumerate(query)}
+
+# Answer several (start_time, end_time, parameter) windows with a single scan
+def fetch_user_windows(
+    windows: List[schemas.UserWindowSpec],
+    db: Session,
+    filters: Optional[schemas.UserFilters] = None,
+    fields: Optional[List[str]] = None
+):
+    # Merge overlapping windows so every row is read once
+    spans = []
+    for start_time, end_time in sorted((w.start_time, w.end_time) for w in windows):
+        if spans and start_time <= spans[-1][1] + 1:
+            spans[-1][1] = max(spans[-1][1], end_time)
+        else:
+            spans.append([start_time, end_time])
+
+    relationships = set(USER_RELATIONSHIPS if fields is None else fields) & set(USER_RELATIONSHIPS)
+    in_spans = or_(*(models.User.originationTime.between(s, e) for s, e in spans))
+
+    query = db.query(models.User).filter(in_spans)
+    query = apply_user_filters(query, filters)
+    users = (
+        query.options(*_relationship_options(relationships))
+        .order_by(models.User.originationTime, models.User.id)
+        .all()
+    )
+    for user in users:
+        if "phones" in relationships:
+            user.phones.sort(key=lambda p: p.identifier)
+        if "voicemails" in relationships:
+            user.voicemails.sort(key=lambda v: v.identifier)
+
+    # One id-only ordering query per distinct parameter, rather than comparing strings
+    # in Python, whose binary order differs from case- and accent-insensitive collations
+    ranks = {
+        parameter: _window_ranks(db, in_spans, parameter, filters)
+        for parameter in {w.parameter for w in windows} if parameter is not None
+    }
+
+    # Split the scan per window by binary search on originationTime
+    times = [user.originationTime for user in users]
+    results = []
+    for window in windows:
+        matched = users[bisect_left(times, window.start_time):bisect_right(times, window.end_time)]
+        if window.parameter is None:
+            matched.sort(key=lambda u: u.id)
+        else:
+            rank = ranks[window.parameter]
+            matched.sort(key=lambda u: rank[u.id])
+        if fields is not None:
+            matched = [_project_row(user, fields) for user in matched]
+        results.append({
+            "start_time": window.start_time,
+            "end_time": window.end_time,
+            "parameter": window.parameter,
+            "users": matched,
+        })
+    return results
+
+def bump_revisions(db: Session, origination_times):
+    """
+    Marks the UTC days of the given origination times as changed. Call it in
+    the transaction that changes users on those days (for a moved user, both
+    the old and the new time), so cached snapshots and exports are rebuilt.
+    """
+    days = {time - time % DAY for time in origination_times}
+    if not days:
+        return
+    existing = {
+        day for (day,) in
+        db.query(models.DataRevision.day).filter(models.DataRevision.day.in_(days))
+    }
+    if existing:
+        db.execute(
+            update(models.DataRevision)
+            .where(models.DataRevision.day.in_(existing))
+            .values(revision=models.DataRevision.revision + 1)
+        )
+    missing = days - existing
+    if missing:
+        db.execute(insert(models.DataRevision), [{"day": day, "revision": 1} for day in missing])
+
+def day_revisions(db: Session, start_time=None, end_time=None):
+    query = db.query(models.DataRevision.day, models.DataRevision.revision)
+    if start_time is not None:
+        query = query.filter(models.DataRevision.day >= start_time - start_time % DAY)
+    if end_time is not None:
+        query = query.filter(models.DataRevision.day <= end_time)
+    return dict(query)
+
+# Cheap fingerprint of the data inside a window, used to invalidate cached exports
+def data_version(start_time: int, end_time: int, db: Session) -> str:
+    in_window = models.User.originationTime.between(start_time, end_time)
+
+    count, id_sum, time_sum = db.query(
+        func.count(models.User.id),
+        func.coalesce(func.sum(models.User.id), 0),
+        func.coalesce(func.sum(models.User.originationTime), 0),
+    ).filter(in_window).one()
+
+    phone_links = (
+        db.query(func.count())
+        .select_from(models.UserPhones)
+        .join(models.User, models.User.id == models.UserPhones.userId)
+        .filter(in_window)
+        .scalar()
+    )
+    voicemail_links = (
+        db.query(func.count())
+        .select_from(models.UserVoicemails)
+        .join(models.User, models.User.id == models.UserVoicemails.userId)
+        .filter(in_window)
+        .scalar()
+    )
+    # Revisions only grow, so their sum changes whenever a day in the window is edited
+    revision = sum(day_revisions(db, start_time, end_time).values())
+
+    return f"{count}-{id_sum}-{time_sum}-{phone_links}-{voicemail_links}-r{revision}"
@@ -1,20 +1,51 @@
+from functools import lru_cache
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
-import os
-from dotenv import load_dotenv
+
+from .config import get_settings
 
 
 # file that sets up the SQLAlchemy Base, engine, and session
+# The engine is created on first use, so importing the app never touches the database
 
-load_dotenv()  # Load environment variables from .env
+@lru_cache(maxsize=1)
+def get_engine():
+    settings = get_settings()
+    pool_options = {}
+    if settings.db_pool_size is not None:
+        pool_options["pool_size"] = settings.db_pool_size
+    if settings.db_max_overflow is not None:
+        pool_options["max_overflow"] = settings.db_max_overflow
+    return create_engine(
+        settings.database_url,
+        pool_pre_ping=True,  # Ensures the connection is alive
+        **pool_options
+    )
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True  # Ensures the connection is alive
-)
+def SessionLocal():
+    if _session_factory.kw.get("bind") is None:
+        _session_factory.configure(bind=get_engine())
+    return _session_factory()
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def dispose_engine():
+    if get_engine.cache_info().currsize:
+        get_engine().dispose()
+
+def __getattr__(name):
+    # Backwards compatible `from app.database import engine`
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 Base = declarative_base()  # Updated to use sqlalchemy.orm.declarative_base
+
+# Dependency to get DB session
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -0,0 +1,107 @@
+# app/devices.py
+
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+from .auth import get_current_user
+from .database import get_db
+
+# Device table, link table and the key column they share
+DEVICE_KINDS = {
+    "phones": (models.Phone, models.UserPhones, "phoneId"),
+    "voicemails": (models.Voicemail, models.UserVoicemails, "vmId"),
+}
+
+router = APIRouter(prefix="/devices", tags=["devices"])
+
+# Devices whose identifier starts with a prefix, with the users of each device
+@router.get("/{kind}", response_model=schemas.DevicePage)
+async def search_devices(
+    kind: Literal["phones", "voicemails"],
+    prefix: str = Query(..., min_length=1, description="Identifier prefix"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    users_limit: int = Query(10, ge=1, le=100, description="Users listed per device"),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    device, link, key = DEVICE_KINDS[kind]
+    device_key = getattr(device, key)
+
+    # Range seek on the unique identifier index, paged by identifier
+    query = db.query(device_key, device.identifier).filter(
+        device.identifier.startswith(prefix, autoescape=True)
+    )
+    if cursor is not None:
+        query = query.filter(device.identifier > cursor)
+    rows = query.order_by(device.identifier).limit(limit + 1).all()
+
+    next_cursor = rows[limit - 1].identifier if len(rows) > limit else None
+    rows = rows[:limit]
+
+    users_by_device = {row[0]: [] for row in rows}
+    if rows:
+        # One lookup through the (device, user) index for the whole page, keeping
+        # the first users_limit + 1 users of each device
+        link_key = getattr(link, key)
+        ranked = (
+            db.query(
+                link_key.label("device_id"),
+                link.userId.label("user_id"),
+                func.row_number().over(partition_by=link_key, order_by=link.userId).label("position"),
+            )
+            .filter(link_key.in_(users_by_device))
+            .subquery()
+        )
+        links = (
+            db.query(ranked.c.device_id, models.User)
+            .join(models.User, models.User.id == ranked.c.user_id)
+            .filter(ranked.c.position <= users_limit + 1)
+            .order_by(ranked.c.device_id, models.User.id)
+        )
+        for device_id, user in links:
+            users_by_device[device_id].append(user)
+
+    return {
+        "devices": [
+            {
+                "identifier": identifier,
+                "users": users_by_device[device_id][:users_limit],
+                "more_users": len(users_by_device[device_id]) > users_limit,
+            }
+            for device_id, identifier in rows
+        ],
+        "next_cursor": next_cursor,
+    }
+
+# Users sharing one device
+@router.get("/{kind}/{identifier}/users", response_model=schemas.DeviceUsersPage)
+async def device_users(
+    kind: Literal["phones", "voicemails"],
+    identifier: str,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, description="next_cursor from the previous page"),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    device, link, key = DEVICE_KINDS[kind]
+
+    device_id = db.query(getattr(device, key)).filter(device.identifier == identifier).scalar()
+    if device_id is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    query = (
+        db.query(models.User)
+        .join(link, link.userId == models.User.id)
+        .filter(getattr(link, key) == device_id)
+    )
+    if cursor is not None:
+        query = query.filter(models.User.id > cursor)
+    users = query.order_by(models.User.id).limit(limit + 1).all()
+
+    next_cursor = users[limit - 1].id if len(users) > limit else None
+    return {"identifier": identifier, "users": users[:limit], "next_cursor": next_cursor}
@@ -0,0 +1,478 @@
+# app/exports.py
+
+import csv
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+
+from . import schemas
+from .auth import get_current_user
+from .crud import DAY, build_users_query, data_version, fetch_users_after, get_user_filters
+from .database import SessionLocal, get_db
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+CSV_HEADER = ["ID", "UserID", "OriginationTime", "ClusterID", "Phones", "Voicemails"]
+
+def csv_row(user):
+    # Phones and voicemails are already sorted in fetch_users
+    return [
+        user.id,
+        user.userId,
+        user.originationTime,
+        user.clusterId,
+        ";".join([phone.identifier for phone in user.phones]),
+        ";".join([vm.identifier for vm in user.voicemails])
+    ]
+
+CSV_COLUMNS = {
+    "id": "ID",
+    "userId": "UserID",
+    "originationTime": "OriginationTime",
+    "clusterId": "ClusterID",
+    "phones": "Phones",
+    "voicemails": "Voicemails",
+}
+
+# Header and row for a projected download (see crud.project_users)
+def csv_projected_header(fields):
+    return [CSV_COLUMNS[field] for field in fields]
+
+def csv_projected_row(row, fields):
+    values = []
+    for field in fields:
+        value = row[field]
+        if field in ("phones", "voicemails"):
+            value = ";".join(device["identifier"] for device in value)
+        values.append(value)
+    return values
+
+# Seconds between automatic prune runs of one worker
+PRUNE_INTERVAL = 60
+
+def export_dir():
+    path = os.path.abspath(os.getenv("EXPORT_DIR", "exports"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class ExportJob:
+    """
+    State of one background export. Persisted next to the file it produces so an
+    interrupted export can resume from its last checkpoint.
+    """
+
+    def __init__(self, id, params_key, start_time, end_time, parameter, version, filters=None):
+        self.id = id
+        self.params_key = params_key
+        self.start_time = start_time
+        self.end_time = end_time
+        self.parameter = parameter
+        self.filters = filters or {}
+        self.version = version
+        self.status = "queued"
+        self.rows_written = 0
+        self.last_key = None
+        self.total_rows = None
+        self.bytes_written = 0
+        self.error = None
+        self.created_at = int(time.time())
+        self.updated_at = self.created_at
+
+    @property
+    def meta_path(self):
+        return os.path.join(export_dir(), f"{self.id}.json")
+
+    @property
+    def part_path(self):
+        return os.path.join(export_dir(), f"{self.id}.csv.part")
+
+    @property
+    def lock_path(self):
+        return os.path.join(export_dir(), f"{self.id}.lock")
+
+    @property
+    def file_path(self):
+        return os.path.join(export_dir(), f"{self.id}.csv")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "params_key": self.params_key,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "parameter": self.parameter,
+            "filters": self.filters,
+            "version": self.version,
+            "status": self.status,
+            "rows_written": self.rows_written,
+            "last_key": self.last_key,
+            "total_rows": self.total_rows,
+            "bytes_written": self.bytes_written,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(
+            data["id"], data["params_key"], data["start_time"],
+            data["end_time"], data["parameter"], data["version"], data.get("filters")
+        )
+        for key in ("status", "rows_written", "total_rows", "bytes_written",
+                    "error", "created_at", "updated_at"):
+            setattr(job, key, data[key])
+        job.last_key = data.get("last_key")
+        return job
+
+    def save(self):
+        """
+        Atomically writes the job state (the checkpoint) to disk.
+        """
+        self.updated_at = int(time.time())
+        tmp_path = f"{self.meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.meta_path)
+
+def _try_lock(path):
+    """
+    Takes an exclusive lock on path without waiting. Returns the open lock file,
+    or None when another process (or thread) holds it. The lock is released
+    when the file is closed, including when its owner dies.
+    """
+    f = open(path, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def lock_file(path):
+    """
+    Takes an exclusive lock on path, waiting for its current holder. Returns
+    the open lock file; closing it releases the lock.
+    """
+    f = open(path, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after about ten seconds, so keep trying
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+def _params_key(start_time, end_time, parameter, filters):
+    return json.dumps([start_time, end_time, parameter, filters], sort_keys=True)
+
+def _job_id(params_key, version):
+    return hashlib.sha256(f"{params_key}|{version}".encode()).hexdigest()[:32]
+
+def _read_job(job_id):
+    meta_path = os.path.join(export_dir(), f"{job_id}.json")
+    try:
+        with open(meta_path) as f:
+            return ExportJob.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+
+class ExportManager:
+    """
+    Runs exports on a small worker pool. Jobs with identical parameters are
+    deduplicated and completed files are reused until the data version changes.
+
+    Workers share EXPORT_DIR, so a job is only run by the process holding its
+    lock file; `jobs` holds the jobs this process runs or has finished, until
+    `prune` deletes them.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pruned_at = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            workers = int(os.getenv("EXPORT_WORKERS", "2"))
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+        return self._executor
+
+    def load(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status != "failed":
+                if os.path.exists(job.meta_path):
+                    return job
+                # Pruned by another worker
+                del self.jobs[job_id]
+            job = _read_job(job_id)
+            if job is None:
+                return None
+            if job.status in ("queued", "running"):
+                # Resume from the checkpoint only if no live process owns the job
+                lock = _try_lock(job.lock_path)
+                if lock is None:
+                    return job
+                job = _read_job(job_id)  # Re-read now that nobody else can write it
+                if job.status not in ("queued", "running"):
+                    lock.close()
+                    return job
+                self._submit(job, lock)
+            if job.status != "failed":
+                self.jobs[job.id] = job
+            return job
+
+    def create(self, start_time, end_time, parameter, db: Session, filters=None):
+        filters = filters.model_dump(exclude_none=True) if filters is not None else {}
+        params_key = _params_key(start_time, end_time, parameter, filters)
+        version = data_version(start_time, end_time, db)
+        job_id = _job_id(params_key, version)
+
+        if time.time() - self._pruned_at >= PRUNE_INTERVAL:
+            self.prune()
+        job = self.load(job_id)
+        with self._lock:
+            job = self.jobs.get(job_id, job)
+            if job is not None and job.status != "failed":
+                return job
+            lock = _try_lock(os.path.join(export_dir(), f"{job_id}.lock"))
+            if lock is None:
+                # Another worker is creating or retrying this export right now
+                return _read_job(job_id) or ExportJob(
+                    job_id, params_key, start_time, end_time, parameter, version, filters
+                )
+            current = _read_job(job_id)
+            if current is not None and current.status != "failed":
+                # Another worker finished it in the meantime
+                lock.close()
+                return current
+            job = current
+            if job is None:
+                job = ExportJob(job_id, params_key, start_time, end_time, parameter, version, filters)
+                self._discard_stale(params_key, job_id)
+            self.jobs[job.id] = job
+            self._submit(job, lock)
+            return job
+
+    def _submit(self, job, lock):
+        # The lock is held from here until _run finishes
+        job.status = "queued"
+        job.error = None
+        job.save()
+        self.executor.submit(self._run, job, lock)
+
+    def _discard_stale(self, params_key, keep_id):
+        """
+        Removes finished exports of the same parameters built from older data.
+        """
+        for meta_path in glob.glob(os.path.join(export_dir(), "*.json")):
+            try:
+                with open(meta_path) as f:
+                    old = ExportJob.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            if old.params_key != params_key or old.id == keep_id:
+                continue
+            if old.status not in ("completed", "failed"):
+                continue
+            self._remove(old)
+
+    def _remove(self, job):
+        """
+        Deletes a finished job and its files, unless a worker is retrying it.
+        """
+        lock = _try_lock(job.lock_path)
+        if lock is None:
+            return False
+        lock.close()
+        for path in (job.file_path, job.part_path, job.meta_path, job.lock_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.jobs.pop(job.id, None)
+        return True
+
+    def prune(self):
+        """
+        Deletes finished exports last updated more than EXPORT_MAX_AGE seconds ago,
+        then the oldest others while EXPORT_DIR holds more than EXPORT_MAX_BYTES.
+        Returns the number of exports deleted.
+        """
+        max_age = int(os.getenv("EXPORT_MAX_AGE", str(7 * DAY)))
+        max_bytes = int(os.getenv("EXPORT_MAX_BYTES", "0"))  # 0: no size limit
+        self._pruned_at = time.time()
+
+        finished = []
+        total = 0
+        for meta_path in glob.glob(os.path.join(export_dir(), "*.json")):
+            try:
+                with open(meta_path) as f:
+                    job = ExportJob.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            size = sum(os.path.getsize(path) for path in (job.file_path, job.part_path)
+                       if os.path.exists(path))
+            total += size
+            if job.status in ("completed", "failed"):
+                finished.append((job.updated_at, size, job))
+
+        cutoff = time.time() - max_age
+        removed = 0
+        with self._lock:
+            for updated_at, size, job in sorted(finished, key=lambda item: item[0]):
+                if updated_at >= cutoff and (not max_bytes or total <= max_bytes):
+                    break
+                if self._remove(job):
+                    total -= size
+                    removed += 1
+            # Finished jobs deleted by other workers
+            for job_id, job in list(self.jobs.items()):
+                if job.status in ("completed", "failed") and not os.path.exists(job.meta_path):
+                    del self.jobs[job_id]
+        if removed:
+            logger.info("Pruned %d exports", removed)
+        return removed
+
+    def _run(self, job, lock):
+        chunk_size = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+        filters = schemas.UserFilters(**job.filters)
+        db = self.session_factory()
+        try:
+            job.status = "running"
+            if job.rows_written and data_version(job.start_time, job.end_time, db) != job.version:
+                # The checkpoint no longer matches the data; start over
+                job.rows_written = 0
+                job.last_key = None
+                job.bytes_written = 0
+            job.total_rows = build_users_query(
+                job.start_time, job.end_time, job.parameter, db, filters
+            ).order_by(None).count()
+            job.save()
+
+            mode = "r+b" if job.bytes_written and os.path.exists(job.part_path) else "wb"
+            if mode == "wb":
+                job.rows_written = 0
+                job.last_key = None
+                job.bytes_written = 0
+
+            with open(job.part_path, mode) as f:
+                f.truncate(job.bytes_written)
+                f.seek(job.bytes_written)
+                output = StringIO()
+                writer = csv.writer(output)
+                if job.bytes_written == 0:
+                    writer.writerow(CSV_HEADER)
+
+                while True:
+                    # Continue after the last exported row rather than skipping an offset
+                    users, last_key = fetch_users_after(
+                        job.start_time, job.end_time, job.parameter, db,
+                        after=job.last_key, limit=chunk_size, filters=filters
+                    )
+                    for user in users:
+                        writer.writerow(csv_row(user))
+                    f.write(output.getvalue().encode("utf-8"))
+                    output.seek(0)
+                    output.truncate(0)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                    # Checkpoint only what is durably on disk
+                    job.rows_written += len(users)
+                    job.last_key = last_key
+                    job.bytes_written = f.tell()
+                    job.save()
+                    db.expunge_all()
+                    if len(users) < chunk_size:
+                        break
+
+            os.replace(job.part_path, job.file_path)
+            job.status = "completed"
+            job.save()
+            logger.info("Export %s completed with %d rows", job.id, job.rows_written)
+        except Exception as e:
+            logger.exception("Export %s failed", job.id)
+            job.status = "failed"
+            job.error = str(e)
+            job.save()
+        finally:
+            db.close()
+            lock.close()
+
+manager = ExportManager()
+
+router = APIRouter(prefix="/exports", tags=["exports"])
+
+def _job_response(job):
+    data = job.to_dict()
+    if job.status == "completed":
+        data["download_url"] = f"/exports/{job.id}/download"
+    return schemas.ExportJob(**data)
+
+# Sync on purpose: data_version and the job bookkeeping block, so they run in the threadpool
+@router.post("/", response_model=schemas.ExportJob, status_code=status.HTTP_202_ACCEPTED)
+def create_export(
+    start_time: int = Query(..., description="Start time in Unix timestamp"),
+    end_time: int = Query(..., description="End time in Unix timestamp"),
+    parameter: Optional[str] = Query(None, description="One of 'user_id', 'phone', 'voicemail', 'cluster'"),
+    filters: schemas.UserFilters = Depends(get_user_filters),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start_time must be less than end_time")
+    if parameter and parameter not in {'user_id', 'phone', 'voicemail', 'cluster'}:
+        raise HTTPException(status_code=400, detail="Invalid parameter value")
+
+    job = manager.create(start_time, end_time, parameter, db, filters)
+    return _job_response(job)
+
+@router.get("/{job_id}", response_model=schemas.ExportJob)
+async def get_export(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = manager.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return _job_response(job)
+
+@router.get("/{job_id}/download")
+async def download_export(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = manager.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    if job.status != "completed" or not os.path.exists(job.file_path):
+        raise HTTPException(status_code=409, detail=f"Export is {job.status}")
+
+    # FileResponse answers Range requests, so interrupted downloads can resume
+    return FileResponse(job.file_path, media_type="text/csv", filename="users.csv")
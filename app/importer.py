@@ -0,0 +1,372 @@
+# app/importer.py
+
+"""
+Streaming CSV import, in the format of data.csv or of /users/download.
+
+Rows are read one at a time and written in chunks of IMPORT_CHUNK_SIZE, each
+chunk in its own transaction, so memory stays bounded however large the file
+is. Existing users are updated (their device lists replaced); clusters and
+devices are created as needed. Rows that cannot be imported are counted and
+reported instead of failing the whole file.
+
+    python -m app.importer data.csv
+"""
+
+import argparse
+import csv
+import io
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from . import models, schemas, snapshots
+from .auth import get_current_user
+from .crud import bump_revisions
+from .changelog import changelog
+from .database import get_db
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+# Accepted headers, compared without spaces and case: data.csv and our own CSV_HEADER
+COLUMNS = {
+    "id": "id",
+    "userid": "userId",
+    "originationtime": "originationTime",
+    "clusterid": "clusterId",
+    "phones": "phones",
+    "voicemails": "voicemails",
+}
+
+# "2024-05-23, 8:17:12 a.m." as written in data.csv; AM/PM spellings also accepted
+_TIMESTAMP = re.compile(
+    r"^\s*(\d{4})-(\d{2})-(\d{2}),?\s+(\d{1,2}):(\d{2}):(\d{2})\s*([ap])\.?\s*m\.?\s*$",
+    re.IGNORECASE,
+)
+
+def import_timezone():
+    return os.getenv("IMPORT_TIMEZONE", "America/Toronto")
+
+@lru_cache(maxsize=None)
+def _zone(name):
+    return ZoneInfo(name)
+
+# Epoch of the start of a local hour; the offset is fixed within an hour, so
+# minutes and seconds can simply be added. A data file spans few distinct hours.
+@lru_cache(maxsize=65536)
+def _hour_start(year, month, day, hour, zone_name):
+    return int(datetime(year, month, day, hour, tzinfo=_zone(zone_name)).timestamp())
+
+def parse_timestamp(value, zone_name=None):
+    """
+    Converts a data.csv timestamp (local time in IMPORT_TIMEZONE) or a plain
+    Unix timestamp to a Unix timestamp.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    match = _TIMESTAMP.match(value)
+    if not match:
+        raise ValueError(f"Unrecognised timestamp: {value!r}")
+    year, month, day, hour, minute, second = (int(part) for part in match.groups()[:6])
+    if not 1 <= hour <= 12 or minute > 59 or second > 59:
+        raise ValueError(f"Invalid time: {value!r}")
+    hour = hour % 12 + (12 if match.group(7).lower() == "p" else 0)
+    return _hour_start(year, month, day, hour, zone_name or import_timezone()) + minute * 60 + second
+
+def _identifiers(value, max_length):
+    identifiers = []
+    for identifier in value.split(";"):
+        identifier = identifier.strip()
+        if not identifier:
+            continue
+        if len(identifier) > max_length:
+            raise ValueError(f"Device identifier too long: {identifier!r}")
+        if identifier not in identifiers:
+            identifiers.append(identifier)
+    return identifiers
+
+def parse_row(row, zone_name=None):
+    """
+    Validates one CSV row (keyed by model field names) into an import record.
+    """
+    try:
+        user_id = int(row["id"])
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid ID: {row['id']!r}")
+    userId = (row["userId"] or "").strip()
+    if not userId or len(userId) > 9:
+        raise ValueError(f"Invalid User ID: {userId!r}")
+    clusterId = (row["clusterId"] or "").strip() or None
+    if clusterId is not None and len(clusterId) > 50:
+        raise ValueError(f"Cluster ID too long: {clusterId!r}")
+    return {
+        "id": user_id,
+        "userId": userId,
+        "originationTime": parse_timestamp(row["originationTime"] or "", zone_name),
+        "clusterId": clusterId,
+        "phones": _identifiers(row["phones"] or "", 20),
+        "voicemails": _identifiers(row["voicemails"] or "", 20),
+    }
+
+def _read_header(reader):
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("The file is empty")
+    columns = [COLUMNS.get(name.replace(" ", "").lower()) for name in header]
+    missing = [name for name in COLUMNS.values() if name not in columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    return columns
+
+# Inserts the clusters that do not exist yet and returns how many there were
+def _ensure_clusters(session: Session, cluster_ids):
+    if not cluster_ids:
+        return 0
+    found = {
+        cluster_id for (cluster_id,) in
+        session.query(models.Cluster.clusterId).filter(models.Cluster.clusterId.in_(cluster_ids))
+    }
+    missing = cluster_ids - found
+    if missing:
+        session.execute(insert(models.Cluster), [{"clusterId": cluster_id} for cluster_id in missing])
+    return len(missing)
+
+# Returns {identifier: primary key}, inserting the identifiers that are new
+def _ensure_devices(session: Session, model, key, identifiers):
+    if not identifiers:
+        return {}, 0
+    column = getattr(model, key)
+    mapping = dict(session.query(model.identifier, column).filter(model.identifier.in_(identifiers)))
+    missing = [identifier for identifier in identifiers if identifier not in mapping]
+    if missing:
+        session.execute(insert(model), [{"identifier": identifier} for identifier in missing])
+        mapping.update(session.query(model.identifier, column).filter(model.identifier.in_(missing)))
+    return mapping, len(missing)
+
+class ImportReport:
+    def __init__(self, max_rejects):
+        self.max_rejects = max_rejects
+        self.rows_read = 0
+        self.users_inserted = 0
+        self.users_updated = 0
+        self.clusters_added = 0
+        self.phones_added = 0
+        self.voicemails_added = 0
+        self.rejected = 0
+        self.rejected_rows = []
+        self.earliest = None
+        self.latest = None
+
+    def reject(self, line, error):
+        self.rejected += 1
+        if len(self.rejected_rows) < self.max_rejects:
+            self.rejected_rows.append({"line": line, "error": error})
+
+    def touched(self, origination_time):
+        # Only the range matters for the snapshot refresh
+        if self.earliest is None or origination_time < self.earliest:
+            self.earliest = origination_time
+        if self.latest is None or origination_time > self.latest:
+            self.latest = origination_time
+
+    @property
+    def changed_times(self):
+        return [] if self.earliest is None else [self.earliest, self.latest]
+
+    def to_dict(self):
+        return {
+            "rows_read": self.rows_read,
+            "users_inserted": self.users_inserted,
+            "users_updated": self.users_updated,
+            "clusters_added": self.clusters_added,
+            "phones_added": self.phones_added,
+            "voicemails_added": self.voicemails_added,
+            "rejected": self.rejected,
+            "rejected_rows": self.rejected_rows,
+        }
+
+def _write_chunk(session: Session, chunk, report: ImportReport):
+    """
+    Upserts one chunk of (line, record) pairs in a single transaction.
+    """
+    # A later row for the same ID replaces an earlier one, which is reported
+    records = {}
+    lines = {}
+    for line, record in chunk:
+        if record["id"] in lines:
+            report.reject(lines[record["id"]], f"Superseded by line {line}")
+        records[record["id"]] = record
+        lines[record["id"]] = line
+
+    User = models.User
+    existing = {
+        user_id: origination_time
+        for user_id, origination_time in session.query(User.id, User.originationTime)
+        .filter(User.id.in_(records))
+    }
+    owners = dict(
+        session.query(User.userId, User.id)
+        .filter(User.userId.in_({record["userId"] for record in records.values()}))
+    )
+    accepted = []
+    for user_id, record in records.items():
+        owner = owners.setdefault(record["userId"], user_id)
+        if owner != user_id:
+            report.reject(lines[user_id], f"User ID {record['userId']} belongs to ID {owner}")
+            continue
+        accepted.append(record)
+    if not accepted:
+        return []
+
+    try:
+        cluster_ids = {record["clusterId"] for record in accepted if record["clusterId"]}
+        clusters_added = _ensure_clusters(session, cluster_ids)
+        phone_ids, phones_added = _ensure_devices(
+            session, models.Phone, "phoneId", {p for record in accepted for p in record["phones"]}
+        )
+        vm_ids, voicemails_added = _ensure_devices(
+            session, models.Voicemail, "vmId", {v for record in accepted for v in record["voicemails"]}
+        )
+
+        columns = ("id", "userId", "originationTime", "clusterId")
+        new_users = [{c: record[c] for c in columns} for record in accepted if record["id"] not in existing]
+        updated_users = [{c: record[c] for c in columns} for record in accepted if record["id"] in existing]
+        if new_users:
+            session.execute(insert(User), new_users)
+        if updated_users:
+            session.execute(update(User), updated_users)
+            updated_ids = [user["id"] for user in updated_users]
+            session.execute(delete(models.UserPhones).where(models.UserPhones.userId.in_(updated_ids)))
+            session.execute(delete(models.UserVoicemails).where(models.UserVoicemails.userId.in_(updated_ids)))
+
+        phone_links = [{"userId": r["id"], "phoneId": phone_ids[p]} for r in accepted for p in r["phones"]]
+        vm_links = [{"userId": r["id"], "vmId": vm_ids[v]} for r in accepted for v in r["voicemails"]]
+        if phone_links:
+            session.execute(insert(models.UserPhones), phone_links)
+        if vm_links:
+            session.execute(insert(models.UserVoicemails), vm_links)
+        # Updates in place are invisible to the snapshot and export fingerprints otherwise
+        bump_revisions(session, [record["originationTime"] for record in accepted]
+                       + [existing[record["id"]] for record in accepted if record["id"] in existing])
+        # Live feeds pick the changes up once this transaction commits
+        changelog.record(session, [record["id"] for record in accepted])
+        session.commit()
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.warning("Import chunk of %d rows failed: %s", len(accepted), e)
+        for record in accepted:
+            report.reject(lines[record["id"]], f"Database error: {e.__class__.__name__}")
+        return []
+
+    report.users_inserted += len(new_users)
+    report.users_updated += len(updated_users)
+    report.clusters_added += clusters_added
+    report.phones_added += phones_added
+    report.voicemails_added += voicemails_added
+    for record in accepted:
+        report.touched(record["originationTime"])
+        if record["id"] in existing:
+            # The user may have moved out of an older snapshot partition
+            report.touched(existing[record["id"]])
+    return [record["id"] for record in accepted]
+
+def import_csv(stream, session: Session, chunk_size=None, max_rejects=None, zone_name=None):
+    """
+    Imports users from a text stream of CSV. Raises ValueError if the header is
+    unusable; row problems are reported in the returned summary instead.
+    """
+    chunk_size = chunk_size or int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+    if max_rejects is None:
+        max_rejects = int(os.getenv("IMPORT_MAX_REJECTS", "100"))
+    zone_name = zone_name or import_timezone()
+    _zone(zone_name)  # Fail early on an unknown time zone
+
+    reader = csv.reader(stream)
+    columns = _read_header(reader)
+    report = ImportReport(max_rejects)
+
+    def flush(chunk):
+        if _write_chunk(session, chunk, report):
+            # Wake the live feeds of this process instead of waiting for their next poll
+            changelog.notify()
+
+    chunk = []
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        report.rows_read += 1
+        line = reader.line_num
+        if len(values) != len(columns):
+            report.reject(line, f"Expected {len(columns)} columns, got {len(values)}")
+            continue
+        try:
+            record = parse_row({c: v for c, v in zip(columns, values) if c}, zone_name)
+        except ValueError as e:
+            report.reject(line, str(e))
+            continue
+        chunk.append((line, record))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    # Rebuild the export snapshots for the days this import touched
+    snapshots.refresh_for_times(session, report.changed_times)
+    logger.info(
+        "Imported %d rows: %d inserted, %d updated, %d rejected",
+        report.rows_read, report.users_inserted, report.users_updated, report.rejected
+    )
+    return report.to_dict()
+
+router = APIRouter(tags=["import"])
+
+# Sync on purpose: parsing and the database writes run in the threadpool
+@router.post("/users/import", response_model=schemas.ImportResult)
+def import_users(
+    file: UploadFile = File(..., description="CSV in the format of data.csv or /users/download"),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    # The upload is already spooled to a temporary file; decode it as it is read
+    stream = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    try:
+        return import_csv(stream, db)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        stream.detach()
+
+def main():
+    """
+    Imports a CSV file from the command line and prints the summary.
+    """
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Import users from a CSV file such as data.csv")
+    parser.add_argument("path")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--timezone", default=None, help="Zone of the timestamps (default IMPORT_TIMEZONE)")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        with open(args.path, encoding="utf-8-sig", newline="") as f:
+            report = import_csv(f, session, chunk_size=args.chunk_size, zone_name=args.timezone)
+        print(f"Read {report['rows_read']} rows: {report['users_inserted']} inserted, "
+              f"{report['users_updated']} updated, {report['rejected']} rejected.")
+        for rejection in report["rejected_rows"]:
+            print(f"  line {rejection['line']}: {rejection['error']}")
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,50 @@
-from fastapi import FastAPI, Depends, Query
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from sqlalchemy import func, asc
 
-from .database import SessionLocal, engine
-from . import models, schemas
+from .config import get_settings, load_env
+from .database import dispose_engine, get_db, get_engine
+from . import models, profiling, schemas, snapshots
 from .auth import router as auth_router, get_current_user
+from .crud import DAY, fetch_users, fetch_user_windows, get_user_fields, get_user_filters
+from .exports import (
+    router as exports_router, CSV_HEADER, csv_row, csv_projected_header, csv_projected_row
+)
+from .changelog import router as feed_router, changelog
+from .devices import router as devices_router
+from .importer import router as import_router
+from .profiling import router as profiles_router, ProfilingMiddleware
+from .utils import RequestIdMiddleware, log_stats
+
+# Only reads .env; the database is not touched until the first request
+load_env()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    settings.validate()
+    if settings.auto_create_schema:
+        # Development convenience; production runs `python -m app.migrate --schema-only`
+        await run_in_threadpool(models.Base.metadata.create_all, bind=get_engine())
+    yield
+    dispose_engine()
 
-# Create the database tables (if not already created)
-models.Base.metadata.create_all(bind=engine)
+app = FastAPI(title="User Data API", lifespan=lifespan)
 
-app = FastAPI(title="User Data API")
+MAX_BATCH_WINDOWS = 200
 
 # Include the authentication router
 app.include_router(auth_router)
+app.include_router(exports_router)
+app.include_router(feed_router)
+app.include_router(devices_router)
+app.include_router(import_router)
+app.include_router(profiles_router)
 
 # Configure CORS (adjust origins as needed)
 app.add_middleware(
@@ -23,63 +53,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Change-Version", "X-Request-ID"],
 )
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-# Helper function to fetch users with ordering
-def fetch_users(
-    start_time: int,
-    end_time: int,
-    parameter: Optional[str],
-    db: Session
-):
-    query = db.query(models.User).filter(
-        models.User.originationTime.between(start_time, end_time)
-    )
-
-    if parameter == 'user_id':
-        query = query.order_by(models.User.userId)
-    elif parameter == 'phone':
-        # Order users by the minimum phone identifier
-        query = (
-            query.outerjoin(models.User.phones)
-            .group_by(models.User.id)
-            .order_by(func.min(models.Phone.identifier).asc())
-        )
-    elif parameter == 'voicemail':
-        # Order users by the minimum voicemail identifier
-        query = (
-            query.outerjoin(models.User.voicemails)
-            .group_by(models.User.id)
-            .order_by(func.min(models.Voicemail.identifier).asc())
-        )
-    elif parameter == 'cluster':
-        query = query.order_by(models.User.clusterId)
-    else:
-        query = query.order_by(models.User.id)
+# Opt-in request profiling; not installed at all unless configured
+if profiling.profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
 
-    users = query.all()
+# Tag each request (and its log records) with an id
+app.add_middleware(RequestIdMiddleware)
 
-    # Sort phones and voicemails for each user
-    for user in users:
-        user.phones.sort(key=lambda p: p.identifier)
-        user.voicemails.sort(key=lambda v: v.identifier)
+# Liveness: the process is up and serving, no dependencies checked
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "logging": log_stats()}
 
-    return users
+# Readiness: the database answers
+@app.get("/readyz")
+def readyz(db: Session = Depends(get_db)):
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": str(e)})
+    return {"status": "ready"}
 
 # Protected Endpoint to Retrieve Users
-@app.get("/users/", response_model=List[schemas.User])
+@app.get("/users/", response_model=List[schemas.UserFields], response_model_exclude_unset=True)
 async def get_users(
+    response: Response,
     start_time: int = Query(..., description="Start time in Unix timestamp"),
     end_time: int = Query(..., description="End time in Unix timestamp"),
     parameter: Optional[str] = Query(None, description="One of 'user_id', 'phone', 'voicemail', 'cluster'"),
+    filters: schemas.UserFilters = Depends(get_user_filters),
+    fields: Optional[List[str]] = Depends(get_user_fields),
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
@@ -90,51 +96,106 @@ async def get_users(
     if parameter and parameter not in {'user_id', 'phone', 'voicemail', 'cluster'}:
         raise HTTPException(status_code=400, detail="Invalid parameter value")
     
+    # Clients pass this to /users/feed to receive only later changes
+    response.headers["X-Change-Version"] = str(changelog.latest(db))
     try:
-        users = fetch_users(start_time, end_time, parameter, db)
+        users = fetch_users(start_time, end_time, parameter, db, filters=filters, fields=fields)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     return users
     # users = fetch_users(start_time, end_time, parameter, db)
     # return users
 
+# Protected Endpoint to Retrieve Several Time Windows at Once
+@app.post("/users/batch", response_model=List[schemas.UserWindow], response_model_exclude_unset=True)
+async def get_users_batch(
+    windows: List[schemas.UserWindowSpec] = Body(..., description="Windows to fetch, answered in order"),
+    filters: schemas.UserFilters = Depends(get_user_filters),
+    fields: Optional[List[str]] = Depends(get_user_fields),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    if not windows:
+        raise HTTPException(status_code=400, detail="At least one window is required")
+    if len(windows) > MAX_BATCH_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_WINDOWS} windows are allowed")
+    for window in windows:
+        if window.start_time >= window.end_time:
+            raise HTTPException(status_code=400, detail="start_time must be less than end_time")
+        if window.parameter and window.parameter not in {'user_id', 'phone', 'voicemail', 'cluster'}:
+            raise HTTPException(status_code=400, detail="Invalid parameter value")
+
+    try:
+        return fetch_user_windows(windows, db, filters=filters, fields=fields)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Endpoint to Download Users as CSV
 @app.get("/users/download")
 async def download_users_csv(
+    request: Request,
     start_time: int = Query(..., description="Start time in Unix timestamp"),
     end_time: int = Query(..., description="End time in Unix timestamp"),
     parameter: Optional[str] = Query(None, description="One of 'user_id', 'phone', 'voicemail', 'cluster'"),
+    order: Optional[str] = Query(None, description="'partition': ordered by UTC day, clusterId, then id, served from snapshots"),
+    filters: schemas.UserFilters = Depends(get_user_filters),
+    fields: Optional[List[str]] = Depends(get_user_fields),
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
-    users = fetch_users(start_time, end_time, parameter, db)
-
     import csv
     from fastapi.responses import StreamingResponse
     from io import StringIO
 
+    cluster_only = filters.model_copy(update={"cluster_id": None}).is_empty()
+    segments = None
+    if order is not None:
+        if order != "partition":
+            raise HTTPException(status_code=400, detail="Invalid order value")
+        if parameter is not None or fields is not None or not cluster_only:
+            raise HTTPException(
+                status_code=400,
+                detail="order=partition cannot be combined with parameter, fields or filters other than cluster_id"
+            )
+        # Whole days are served from precomputed snapshots when they are up to date;
+        # without any, the same day/cluster/id order is produced live
+        segments = snapshots.plan_download(start_time, end_time, db, filters.cluster_id)
+        if segments is None:
+            segments = [("live", start_time, end_time, filters.cluster_id)]
+    elif (parameter is None and fields is None and cluster_only and filters.cluster_id
+          and len(set(filters.cluster_id)) == 1 and start_time // DAY == end_time // DAY):
+        # Within one cluster and one UTC day the partition order is the id order,
+        # so a snapshot can serve the default download as it is
+        segments = snapshots.plan_download(start_time, end_time, db, filters.cluster_id)
+
+    if segments is not None:
+        gzip_encoding = "gzip" in request.headers.get("accept-encoding", "")
+        response = StreamingResponse(
+            profiling.profile_iter(snapshots.iter_download(segments, db, gzip_encoding)),
+            media_type="text/csv"
+        )
+        if gzip_encoding:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Content-Disposition"] = "attachment; filename=users.csv"
+        return response
+
+    users = fetch_users(start_time, end_time, parameter, db, filters=filters, fields=fields)
+
     def iter_csv():
         output = StringIO()
         writer = csv.writer(output)
-        writer.writerow(["ID", "UserID", "OriginationTime", "ClusterID", "Phones", "Voicemails"])
+        writer.writerow(CSV_HEADER if fields is None else csv_projected_header(fields))
         yield output.getvalue()
         output.seek(0)
         output.truncate(0)
 
         for user in users:
-            # Phones and voicemails are already sorted in fetch_users
-            writer.writerow([
-                user.id,
-                user.userId,
-                user.originationTime,
-                user.clusterId,
-                ";".join([phone.identifier for phone in user.phones]),
-                ";".join([vm.identifier for vm in user.voicemails])
-            ])
+            writer.writerow(csv_row(user) if fields is None else csv_projected_row(user, fields))
             yield output.getvalue()
             output.seek(0)
             output.truncate(0)
 
-    response = StreamingResponse(iter_csv(), media_type="text/csv")
+    response = StreamingResponse(profiling.profile_iter(iter_csv()), media_type="text/csv")
     response.headers["Content-Disposition"] = "attachment; filename=users.csv"
     return response
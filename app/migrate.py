@@ -1,9 +1,13 @@
 # migrate.py
 
+import argparse
 import json
 from sqlalchemy.orm import Session
-from database import engine, SessionLocal, Base  # Import Base from database.py
-from models import Cluster, User, Phone, Voicemail, UserPhones, UserVoicemails
+from .database import get_engine, SessionLocal, Base  # Import Base from database.py
+from .models import Cluster, User, Phone, Voicemail, UserPhones, UserVoicemails
+from . import snapshots
+from .crud import bump_revisions
+from .changelog import changelog
 from sqlalchemy.exc import IntegrityError
 
 def load_json(file_path):
@@ -62,6 +66,7 @@ def migrate_data(data, session: Session):
 
     # Step 3: Populate Users and Relationships
     users_added = 0
+    added_user_ids = []
     user_phone_relations = []
     user_voicemail_relations = []
 
@@ -86,6 +91,7 @@ def migrate_data(data, session: Session):
         )
         session.add(user)
         users_added += 1
+        added_user_ids.append(user_id)
         session.flush()  # Flush to assign relationships
 
         # Associate Phones
@@ -113,6 +119,12 @@ def migrate_data(data, session: Session):
         session.bulk_save_objects(user_voicemail_relations)
         print(f"Associated {len(user_voicemail_relations)} voicemail relationships.")
 
+    # Invalidate the cached snapshots and exports of the days that changed
+    added = set(added_user_ids)
+    bump_revisions(session, (record['originationTime'] for record in data if record['_id'] in added))
+    # Live feeds in any process pick the new users up once this commits
+    changelog.record(session, added_user_ids)
+
     # Commit all changes
     try:
         session.commit()
@@ -120,17 +132,33 @@ def migrate_data(data, session: Session):
     except IntegrityError as e:
         session.rollback()
         print(f"IntegrityError occurred: {e.orig}")
+        return
     except Exception as e:
         session.rollback()
         print(f"An unexpected error occurred: {str(e)}")
+        return
+
+    # Feeds in this process need not wait for their next poll
+    changelog.notify()
+
+    # Rebuild the export snapshots for the days this batch touched
+    rebuilt = snapshots.refresh_for_times(session, (record['originationTime'] for record in data))
+    print(f"Rebuilt {rebuilt} snapshot partitions.")
 
 def main():
     """
     Main function to perform migration.
     """
+    parser = argparse.ArgumentParser(description="Create the schema and load documents.json")
+    parser.add_argument("--schema-only", action="store_true",
+                        help="Create missing tables and indexes, then exit")
+    args = parser.parse_args()
+
     # Create all tables (if not already created)
-    from models import Cluster, User, Phone, Voicemail, UserPhones, UserVoicemails
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+    print("Schema is up to date.")
+    if args.schema_only:
+        return
 
     # Create a new database session
     session = SessionLocal()
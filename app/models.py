@@ -5,6 +5,7 @@ from sqlalchemy import (
     Integer,
     String,
     ForeignKey,
+    Index,
     UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
@@ -34,6 +35,12 @@ class User(Base):
     phones = relationship('Phone', secondary='User_Phones', back_populates='users')
     voicemails = relationship('Voicemail', secondary='User_Voicemails', back_populates='users')
 
+    # Time-range scans, alone or within a set of clusters
+    __table_args__ = (
+        Index('ix_users_origination_time', 'originationTime', 'id'),
+        Index('ix_users_cluster_time', 'clusterId', 'originationTime'),
+    )
+
     def __repr__(self):
         return f"<User(id={self.id}, userId='{self.userId}')>"
 
@@ -70,6 +77,11 @@ class UserPhones(Base):
     userId = Column(Integer, ForeignKey('Users.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
     phoneId = Column(Integer, ForeignKey('Phones.phoneId', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
 
+    # The primary key leads with userId; device-to-user lookups need the reverse
+    __table_args__ = (
+        Index('ix_user_phones_phone', 'phoneId', 'userId'),
+    )
+
     def __repr__(self):
         return f"<UserPhones(userId={self.userId}, phoneId={self.phoneId})>"
 
@@ -78,5 +90,35 @@ class UserVoicemails(Base):
     userId = Column(Integer, ForeignKey('Users.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
     vmId = Column(Integer, ForeignKey('Voicemails.vmId', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
 
+    # The primary key leads with userId; device-to-user lookups need the reverse
+    __table_args__ = (
+        Index('ix_user_voicemails_vm', 'vmId', 'userId'),
+    )
+
     def __repr__(self):
         return f"<UserVoicemails(userId={self.userId}, vmId={self.vmId})>"
+
+class DataRevision(Base):
+    __tablename__ = 'Data_Revisions'
+
+    # Bumped for every UTC day whose users are changed by migrate or the importer;
+    # part of the snapshot and export fingerprints, so in-place edits invalidate them
+    day = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<DataRevision(day={self.day}, revision={self.revision})>"
+
+class UserChange(Base):
+    __tablename__ = 'User_Changes'
+
+    # One row per user written by migrate or the importer, added in the same transaction;
+    # the live feed in any process streams them in version order
+    version = Column(Integer, primary_key=True, autoincrement=True)
+    userId = Column(Integer, nullable=False)
+
+    # Never reuse the version of a trimmed row
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f"<UserChange(version={self.version}, userId={self.userId})>"
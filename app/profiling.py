@@ -0,0 +1,213 @@
+# app/profiling.py
+
+"""
+Opt-in per-request CPU profiling.
+
+A request is profiled when it carries X-Profile-Token matching PROFILE_TOKEN, or
+when it falls in the PROFILE_SAMPLE_RATE fraction of traffic. The middleware is
+only installed when one of those is configured, so a disabled profiler costs
+nothing. Profiles are pstats dumps (callers/callees with timings, readable with
+``python -m pstats`` or snakeviz) kept in a bounded ring in PROFILE_DIR.
+"""
+
+import contextvars
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import re
+import time
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+
+from .auth import get_current_user
+from .utils import get_logger, request_id_var
+
+logger = get_logger(__name__)
+
+_current_session = contextvars.ContextVar("profile_session", default=None)
+_PROFILE_NAME = re.compile(r"^[\w.-]+\.prof$")
+
+def profiling_enabled():
+    return bool(os.getenv("PROFILE_TOKEN")) or _sample_rate() > 0
+
+def _sample_rate():
+    return float(os.getenv("PROFILE_SAMPLE_RATE", "0") or 0)
+
+def profile_dir():
+    path = os.path.abspath(os.getenv("PROFILE_DIR", "profiles"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _enable(profiler):
+    try:
+        profiler.enable()
+        return True
+    except ValueError:
+        # Another profiler is already active (Python 3.12+ allows only one)
+        return False
+
+class ProfileSession:
+    """
+    The profiles collected for one request. Work that runs on other threads
+    (streamed CSV generation) gets its own profiler; they are merged on save.
+    """
+
+    def __init__(self):
+        self.profilers = []
+
+    def new_profiler(self):
+        profiler = cProfile.Profile()
+        self.profilers.append(profiler)
+        return profiler
+
+    def stats(self):
+        stats = None
+        for profiler in self.profilers:
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        return stats
+
+class _ProfiledAwaitable:
+    """
+    Drives a coroutine with the profiler enabled only while that coroutine is
+    running, so other requests sharing the event loop stay out of the profile.
+    """
+
+    def __init__(self, coro, profiler):
+        self.coro = coro
+        self.profiler = profiler
+
+    def __await__(self):
+        send_value, error = None, None
+        while True:
+            enabled = _enable(self.profiler)
+            try:
+                if error is not None:
+                    yielded = self.coro.throw(error)
+                else:
+                    yielded = self.coro.send(send_value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if enabled:
+                    self.profiler.disable()
+            try:
+                send_value, error = (yield yielded), None
+            except GeneratorExit:
+                self.coro.close()
+                raise
+            except BaseException as e:
+                send_value, error = None, e
+
+def profile_iter(iterable):
+    """
+    Profiles a synchronous iterator (e.g. a CSV body) as part of the current
+    request. Returns the iterable untouched when the request is not profiled.
+    """
+    session = _current_session.get()
+    if session is None:
+        return iterable
+    return _profiled_iter(iterable, session.new_profiler())
+
+def _profiled_iter(iterable, profiler):
+    iterator = iter(iterable)
+    while True:
+        enabled = _enable(profiler)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if enabled:
+                profiler.disable()
+        yield item
+
+def _save(session, method, path, duration):
+    stats = session.stats()
+    if stats is None:
+        return None
+    slug = re.sub(r"[^\w]+", "_", path).strip("_") or "root"
+    request_id = re.sub(r"[^\w-]+", "", request_id_var.get() or "")[:32]
+    name = f"{int(time.time() * 1000)}-{method}-{slug}-{request_id or 'none'}.prof"[:200]
+    if not name.endswith(".prof"):
+        name += ".prof"
+    directory = profile_dir()
+    stats.dump_stats(os.path.join(directory, name))
+
+    # Keep only the newest PROFILE_MAX_FILES profiles
+    keep = int(os.getenv("PROFILE_MAX_FILES", "50"))
+    files = sorted(
+        (f for f in os.listdir(directory) if _PROFILE_NAME.match(f)),
+        key=lambda f: os.path.getmtime(os.path.join(directory, f)),
+    )
+    for old in files[:-keep] if keep > 0 else files:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            pass
+    logger.info("Saved profile %s (%.1f ms)", name, duration * 1000)
+    return name
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.token = os.getenv("PROFILE_TOKEN") or None
+        self.sample_rate = _sample_rate()
+
+    def _should_profile(self, scope):
+        if self.token:
+            for key, value in scope.get("headers", []):
+                if key == b"x-profile-token":
+                    if hmac.compare_digest(value, self.token.encode()):
+                        return True
+                    break
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfileSession()
+        token = _current_session.set(session)
+        started = time.perf_counter()
+        try:
+            await _ProfiledAwaitable(self.app(scope, receive, send), session.new_profiler())
+        finally:
+            _current_session.reset(token)
+            duration = time.perf_counter() - started
+            try:
+                await anyio.to_thread.run_sync(
+                    _save, session, scope["method"], scope["path"], duration
+                )
+            except Exception:
+                logger.exception("Could not save profile")
+
+router = APIRouter(prefix="/admin/profiles", tags=["admin"])
+
+@router.get("/")
+async def list_profiles(current_user: dict = Depends(get_current_user)):
+    directory = profile_dir()
+    profiles = []
+    for name in os.listdir(directory):
+        if not _PROFILE_NAME.match(name):
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        profiles.append({"name": name, "size": stat.st_size, "created": int(stat.st_mtime)})
+    return sorted(profiles, key=lambda p: p["created"], reverse=True)
+
+@router.get("/{name}")
+async def download_profile(name: str, current_user: dict = Depends(get_current_user)):
+    path = os.path.join(profile_dir(), name)
+    if not _PROFILE_NAME.match(name) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
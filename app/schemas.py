@@ -27,7 +27,7 @@ class UserBase(BaseModel):
     id: int  # Changed from str to int
     userId: str 
     originationTime: int
-    clusterId: str
+    clusterId: Optional[str] = None  # NULL for imported rows without a cluster
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -37,6 +37,78 @@ class User(UserBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class UserFilters(BaseModel):
+    cluster_id: Optional[List[str]] = None
+    user_id_prefix: Optional[str] = None
+    phone: Optional[str] = None
+    phone_prefix: Optional[str] = None
+    voicemail: Optional[str] = None
+    voicemail_prefix: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return not any(self.model_dump().values())
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+
+# Projection of User where only the requested `fields` are present
+class UserFields(BaseModel):
+    id: Optional[int] = None
+    userId: Optional[str] = None
+    originationTime: Optional[int] = None
+    clusterId: Optional[str] = None
+    phones: Optional[List[Phone]] = None
+    voicemails: Optional[List[Voicemail]] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class UserWindowSpec(BaseModel):
+    start_time: int
+    end_time: int
+    parameter: Optional[str] = None
+
+class UserWindow(UserWindowSpec):
+    users: List[UserFields]
+
+class ExportJob(BaseModel):
+    id: str
+    status: str
+    start_time: int
+    end_time: int
+    parameter: Optional[str] = None
+    rows_written: int
+    total_rows: Optional[int] = None
+    bytes_written: int
+    error: Optional[str] = None
+    created_at: int
+    updated_at: int
+    download_url: Optional[str] = None
+
+class DeviceUsers(BaseModel):
+    identifier: str
+    users: List[UserBase] = []
+    more_users: bool = False  # The rest are paged by /devices/{kind}/{identifier}/users
+
+class DevicePage(BaseModel):
+    devices: List[DeviceUsers]
+    next_cursor: Optional[str] = None
+
+class DeviceUsersPage(BaseModel):
+    identifier: str
+    users: List[UserBase]
+    next_cursor: Optional[int] = None
+
+class ImportRejection(BaseModel):
+    line: int
+    error: str
+
+class ImportResult(BaseModel):
+    rows_read: int
+    users_inserted: int
+    users_updated: int
+    clusters_added: int
+    phones_added: int
+    voicemails_added: int
+    rejected: int
+    rejected_rows: List[ImportRejection]
@@ -0,0 +1,292 @@
+# app/server.py
+
+"""
+Production launcher: a pre-fork supervisor running N uvicorn workers.
+
+The app is imported once in the supervisor and the workers are forked from it,
+all accepting on one shared listening socket. Nothing in the app connects to
+the database at import time, so every worker opens its own pool. Workers are
+replaced when they exit (including after --max-requests), SIGHUP replaces them
+one at a time without dropping the socket, and SIGTERM/SIGINT stop them
+gracefully.
+
+    python run.py --prod --workers 4
+    python -m app.server --port 8000
+"""
+
+import argparse
+import importlib.util
+import os
+import select
+import signal
+import socket
+import time
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+from .config import load_env
+from .utils import get_logger, shutdown_logging
+
+logger = get_logger(__name__)
+
+# Exit status of a worker whose lifespan startup failed; respawning it would only fail again
+STARTUP_FAILURE = 3
+
+def event_loop():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+def http_protocol():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+def pool_size_per_worker(max_connections, workers):
+    """
+    Splits the database connection budget between workers. One extra worker is
+    counted because old and new workers overlap during a rolling restart.
+    """
+    return max(1, max_connections // (workers + 1))
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+class _WorkerServer(uvicorn.Server):
+    # Tells the supervisor when this worker is accepting requests
+    def __init__(self, config, ready_fd):
+        super().__init__(config)
+        self.ready_fd = ready_fd
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        if self.started:
+            os.write(self.ready_fd, b"1")
+
+class Supervisor:
+    def __init__(self, app_path, host, port, workers, max_requests=None, max_requests_jitter=0,
+                 graceful_timeout=30, log_level="info"):
+        self.app_path = app_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.log_level = log_level
+        self.app = None
+        self.sock = None
+        self.children = {}  # pid -> (started_at, ready_fd)
+        self.signals = []
+
+    def _bind(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_worker(write_fd)
+        os.close(write_fd)
+        self.children[pid] = (time.monotonic(), read_fd)
+        return pid
+
+    def _run_worker(self, ready_fd):
+        # Only the supervisor reacts to SIGHUP; uvicorn installs its own SIGTERM/SIGINT handlers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        status = 1
+        try:
+            config = uvicorn.Config(
+                self.app,
+                loop=event_loop(),
+                http=http_protocol(),
+                lifespan="on",
+                log_level=self.log_level,
+                limit_max_requests=self.max_requests,
+                limit_max_requests_jitter=self.max_requests_jitter,
+                timeout_graceful_shutdown=self.graceful_timeout,
+            )
+            server = _WorkerServer(config, ready_fd)
+            server.run(sockets=[self.sock])
+            status = 0 if server.started else STARTUP_FAILURE
+        except SystemExit as e:
+            # uvicorn exits with STARTUP_FAILURE when the lifespan startup fails
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("Worker %d crashed", os.getpid())
+        finally:
+            shutdown_logging()
+            os._exit(status)
+
+    def _wait_ready(self, pid, timeout):
+        """
+        Waits until a new worker has finished its startup. Returns False if it
+        exited or did not become ready in time.
+        """
+        read_fd = self.children[pid][1]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            readable, _, _ = select.select([read_fd], [], [], 0.5)
+            if readable:
+                return os.read(read_fd, 1) == b"1"
+        return False
+
+    def _reap(self):
+        exited = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            started_at, read_fd = self.children.pop(pid, (None, None))
+            if read_fd is not None:
+                os.close(read_fd)
+            exited.append((pid, os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def _signal_children(self, sig, pids=None):
+        for pid in list(self.children if pids is None else pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _stop(self, pids=None):
+        """
+        Asks workers to finish their in-flight requests, killing any that are
+        still running after graceful_timeout.
+        """
+        pids = set(self.children if pids is None else pids)
+        self._signal_children(signal.SIGTERM, pids)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while pids & set(self.children) and time.monotonic() < deadline:
+            for pid, _ in self._reap():
+                pids.discard(pid)
+            time.sleep(0.1)
+        remaining = pids & set(self.children)
+        if remaining:
+            logger.warning("Killing %d workers that did not stop in time", len(remaining))
+            self._signal_children(signal.SIGKILL, remaining)
+            while remaining & set(self.children):
+                self._reap()
+                time.sleep(0.05)
+
+    def _rolling_restart(self):
+        old = list(self.children)
+        logger.info("Rolling restart of %d workers", len(old))
+        for pid in old:
+            if pid not in self.children:
+                continue
+            new_pid = self._spawn()
+            if not self._wait_ready(new_pid, self.graceful_timeout):
+                # Reap the replacement here so run() does not take its exit for a failed boot
+                self._stop([new_pid])
+                logger.error(
+                    "Replacement worker %d did not start; keeping the %d current workers",
+                    new_pid, len(self.children)
+                )
+                return
+            self._stop([pid])
+
+    def _on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        load_env()
+        # Preload: import the app once so workers start from a warm copy
+        self.app = import_from_string(self.app_path)
+        self.sock = self._bind()
+        logger.info(
+            "Listening on %s:%d with %d workers (loop=%s, http=%s)",
+            self.host, self.port, self.workers, event_loop(), http_protocol()
+        )
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._on_signal)
+        for _ in range(self.workers):
+            self._spawn()
+
+        exit_code = 0
+        try:
+            while True:
+                while self.signals:
+                    signum = self.signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self._rolling_restart()
+                    else:
+                        return exit_code
+
+                for pid, code in self._reap():
+                    if code == STARTUP_FAILURE:
+                        logger.error("Worker %d failed to start; shutting down", pid)
+                        exit_code = STARTUP_FAILURE
+                        return exit_code
+                    if code != 0:
+                        logger.warning("Worker %d exited with status %d", pid, code)
+
+                # Replace workers that exited, e.g. after reaching max_requests
+                while len(self.children) < self.workers:
+                    self._spawn()
+                time.sleep(0.5)
+        finally:
+            logger.info("Stopping %d workers", len(self.children))
+            self._stop()
+            self.sock.close()
+
+def main(argv=None):
+    """
+    Starts the pre-fork server. Settings default to the WEB_CONCURRENCY, HOST,
+    PORT, MAX_REQUESTS, MAX_REQUESTS_JITTER, GRACEFUL_TIMEOUT and
+    DB_MAX_CONNECTIONS environment variables.
+    """
+    load_env()
+    parser = argparse.ArgumentParser(description="Run the API with multiple worker processes")
+    parser.add_argument("--app", default="app.main:app")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=_env_int("PORT", 8000))
+    parser.add_argument("--workers", type=int, default=_env_int("WEB_CONCURRENCY", os.cpu_count() or 1))
+    parser.add_argument("--max-requests", type=int, default=_env_int("MAX_REQUESTS", None),
+                        help="Restart a worker after this many requests")
+    parser.add_argument("--max-requests-jitter", type=int, default=_env_int("MAX_REQUESTS_JITTER", 0),
+                        help="Random extra requests per worker, so they do not restart together")
+    parser.add_argument("--graceful-timeout", type=int, default=_env_int("GRACEFUL_TIMEOUT", 30))
+    parser.add_argument("--db-max-connections", type=int, default=_env_int("DB_MAX_CONNECTIONS", None),
+                        help="Connections the database allows this server in total")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+
+    workers = max(1, args.workers)
+    if args.db_max_connections and not os.getenv("DB_POOL_SIZE"):
+        os.environ["DB_POOL_SIZE"] = str(pool_size_per_worker(args.db_max_connections, workers))
+        os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+
+    if not hasattr(os, "fork"):
+        # No fork on Windows: let uvicorn spawn workers that each import the app
+        uvicorn.run(args.app, host=args.host, port=args.port, workers=workers,
+                    limit_max_requests=args.max_requests,
+                    limit_max_requests_jitter=args.max_requests_jitter,
+                    timeout_graceful_shutdown=args.graceful_timeout,
+                    log_level=args.log_level)
+        return 0
+
+    supervisor = Supervisor(
+        args.app, args.host, args.port, workers,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests_jitter,
+        graceful_timeout=args.graceful_timeout,
+        log_level=args.log_level,
+    )
+    return supervisor.run()
+
+if __name__ == "__main__":
+    raise SystemExit(main())
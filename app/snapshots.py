@@ -0,0 +1,440 @@
+# app/snapshots.py
+
+"""
+Precomputed CSV snapshots partitioned by UTC day and clusterId.
+
+Each partition is stored as a raw DEFLATE segment that ends on a sync flush, so
+any run of partitions can be sent back to back inside a single gzip member
+without recompressing them. The manifest records a fingerprint of the rows each
+file was built from, which lets ``refresh`` rebuild only what changed.
+
+A rebuilt partition gets a new file name, so a download that is already
+streaming the old file is not affected. Files the manifest no longer refers to
+are deleted by a later refresh, once SNAPSHOT_GRACE_SECONDS have passed.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import struct
+import time
+import uuid
+import zlib
+from io import StringIO
+from urllib.parse import quote
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+
+from . import models
+from .crud import DAY, day_revisions
+from .exports import CSV_HEADER, csv_row, lock_file
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+READ_BLOCK = 256 * 1024
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+DEFLATE_END = b"\x03\x00"  # Empty final block
+
+def snapshot_dir():
+    path = os.path.abspath(os.getenv("SNAPSHOT_DIR", "snapshots"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _lock_path():
+    return os.path.join(snapshot_dir(), "refresh.lock")
+
+def _manifest_path():
+    return os.path.join(snapshot_dir(), "manifest.json")
+
+def load_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_manifest(manifest):
+    tmp_path = f"{_manifest_path()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, _manifest_path())
+
+def _partition_key(day, cluster_id):
+    token = "none" if cluster_id is None else "c_" + quote(cluster_id, safe="")
+    return f"{day}|{token}"
+
+def _partition_path(day, cluster_id):
+    # Unique per build: a file is never rewritten while a download may be reading it
+    token = "none" if cluster_id is None else "c_" + quote(cluster_id, safe="")
+    return os.path.join(str(day), f"{token}.{uuid.uuid4().hex}.deflate")
+
+def _cluster_sort_key(cluster_id):
+    # Matches SQL ascending order, where NULL sorts first
+    return (cluster_id is not None, cluster_id or "")
+
+# CRC-32 of two concatenated buffers from their separate CRCs (zlib's crc32_combine)
+def _gf2_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, row) for row in mat]
+
+def crc32_combine(crc1, crc2, len2):
+    if len2 == 0:
+        return crc1
+    odd = [0xedb88320] + [1 << i for i in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+def _deflate_segment(data: bytes):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _csv_bytes(rows):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+def _day_expr():
+    return models.User.originationTime - models.User.originationTime % DAY
+
+def partition_fingerprints(db: Session, start_time=None, end_time=None, cluster_ids=None):
+    """
+    Returns {(day, clusterId): fingerprint} for every non-empty partition in range.
+    """
+    day = _day_expr()
+
+    def in_range(query):
+        if cluster_ids:
+            query = query.filter(models.User.clusterId.in_(cluster_ids))
+        if start_time is not None:
+            query = query.filter(models.User.originationTime >= start_time)
+        if end_time is not None:
+            query = query.filter(models.User.originationTime <= end_time)
+        return query
+
+    users = in_range(db.query(
+        day, models.User.clusterId, func.count(models.User.id),
+        func.sum(models.User.id), func.sum(models.User.originationTime),
+    )).group_by(day, models.User.clusterId)
+
+    links = {}
+    for position, table in enumerate((models.UserPhones, models.UserVoicemails)):
+        counts = in_range(
+            db.query(day, models.User.clusterId, func.count())
+            .select_from(table)
+            .join(models.User, models.User.id == table.userId)
+        ).group_by(day, models.User.clusterId)
+        for row_day, cluster_id, count in counts:
+            links.setdefault((int(row_day), cluster_id), [0, 0])[position] = count
+
+    # The counts and sums miss in-place edits; writers bump the day's revision for those
+    revisions = day_revisions(db, start_time, end_time)
+
+    fingerprints = {}
+    for row_day, cluster_id, count, id_sum, time_sum in users:
+        key = (int(row_day), cluster_id)
+        link_counts = links.get(key, [0, 0])
+        values = [count, id_sum, time_sum] + link_counts + [revisions.get(key[0], 0)]
+        fingerprints[key] = "-".join(str(int(v)) for v in values)
+    return fingerprints
+
+def fetch_partition_users(db: Session, start_time, end_time, cluster_id=..., cluster_ids=None,
+                          yield_per=None):
+    """
+    Users in [start_time, end_time] ordered the way snapshots are laid out:
+    by day, then clusterId, then id.
+    """
+    query = (
+        db.query(models.User)
+        .options(selectinload(models.User.phones), selectinload(models.User.voicemails))
+        .filter(models.User.originationTime.between(start_time, end_time))
+    )
+    if cluster_id is not ...:
+        query = query.filter(models.User.clusterId.is_(None) if cluster_id is None
+                             else models.User.clusterId == cluster_id)
+    if cluster_ids:
+        query = query.filter(models.User.clusterId.in_(cluster_ids))
+    query = query.order_by(_day_expr(), models.User.clusterId, models.User.id)
+    if yield_per:
+        query = query.yield_per(yield_per)
+
+    for user in query:
+        user.phones.sort(key=lambda p: p.identifier)
+        user.voicemails.sort(key=lambda v: v.identifier)
+        yield user
+
+def _build_partition(db: Session, day, cluster_id, fingerprint):
+    relative_path = _partition_path(day, cluster_id)
+    path = os.path.join(snapshot_dir(), relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        batch = []
+        users = fetch_partition_users(db, day, day + DAY - 1, cluster_id, yield_per=1000)
+        for user in users:
+            batch.append(csv_row(user))
+            if len(batch) == 1000:
+                data = _csv_bytes(batch)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                f.write(compressor.compress(data))
+                batch = []
+        data = _csv_bytes(batch)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        f.write(compressor.compress(data))
+        f.write(compressor.flush(zlib.Z_SYNC_FLUSH))
+    os.replace(tmp_path, path)
+
+    return {
+        "day": day,
+        "clusterId": cluster_id,
+        "file": relative_path,
+        "fingerprint": fingerprint,
+        "crc": crc,
+        "size": size,
+    }
+
+def _supersede(entry):
+    # Starts the file's grace period; downloads planned before now may still open it
+    try:
+        os.utime(os.path.join(snapshot_dir(), entry["file"]))
+    except FileNotFoundError:
+        pass
+
+def _sweep(manifest):
+    """
+    Deletes partition files (and leftovers of failed builds) that the manifest
+    does not refer to and that were superseded at least SNAPSHOT_GRACE_SECONDS ago.
+    """
+    root = snapshot_dir()
+    cutoff = time.time() - float(os.getenv("SNAPSHOT_GRACE_SECONDS", "300"))
+    referenced = {entry["file"] for entry in manifest.values()}
+    for path in glob.glob(os.path.join(root, "*", "*.deflate*")):
+        if os.path.relpath(path, root) in referenced:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Already gone, or still open on Windows: try again on the next refresh
+            pass
+    for path in glob.glob(os.path.join(root, "*", "")):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+def refresh(db: Session, start_time=None, end_time=None):
+    """
+    Rebuilds the partitions in range whose data changed since they were built,
+    and drops partitions that no longer have any rows. Returns the number rebuilt.
+    """
+    if start_time is not None:
+        start_time -= start_time % DAY
+    if end_time is not None:
+        end_time += DAY - 1 - end_time % DAY
+
+    # One refresh at a time across workers and the CLI, so none of them rebuilds
+    # from an outdated manifest or sweeps a file another one just wrote
+    lock = lock_file(_lock_path())
+    try:
+        fingerprints = partition_fingerprints(db, start_time, end_time)
+        manifest = load_manifest()
+        rebuilt = 0
+        for (day, cluster_id), fingerprint in fingerprints.items():
+            key = _partition_key(day, cluster_id)
+            entry = manifest.get(key)
+            if entry and entry["fingerprint"] == fingerprint:
+                continue
+            manifest[key] = _build_partition(db, day, cluster_id, fingerprint)
+            rebuilt += 1
+            if entry:
+                _supersede(entry)
+
+        for key, entry in list(manifest.items()):
+            if (entry["day"], entry["clusterId"]) in fingerprints:
+                continue
+            if start_time is not None and entry["day"] < start_time:
+                continue
+            if end_time is not None and entry["day"] > end_time:
+                continue
+            _supersede(entry)
+            del manifest[key]
+
+        _save_manifest(manifest)
+        _sweep(manifest)
+    finally:
+        lock.close()
+
+    logger.info("Rebuilt %d snapshot partitions", rebuilt)
+    return rebuilt
+
+def refresh_for_times(db: Session, origination_times):
+    """
+    Incremental rebuild after ingest: only the days touched by the new rows.
+    """
+    origination_times = list(origination_times)
+    if not origination_times:
+        return 0
+    return refresh(db, min(origination_times), max(origination_times))
+
+def _open_partition(entry):
+    try:
+        return open(os.path.join(snapshot_dir(), entry["file"]), "rb")
+    except FileNotFoundError:
+        # Swept after a newer refresh; the day is served live instead
+        return None
+
+def plan_download(start_time, end_time, db: Session, cluster_ids=None):
+    """
+    Splits a download window into snapshot files for whole, up-to-date days and
+    live segments for the unaligned edges and stale days. Returns None when no
+    snapshot can be used.
+
+    The snapshot files are opened here, so a refresh that supersedes them
+    afterwards does not change what this download sends.
+    """
+    manifest = load_manifest()
+    if not manifest:
+        return None
+
+    first_day = -(-start_time // DAY) * DAY
+    end_of_days = (end_time + 1) // DAY * DAY
+    if first_day >= end_of_days:
+        return None
+
+    fingerprints = partition_fingerprints(db, first_day, end_of_days - 1, cluster_ids)
+    clusters_by_day = {}
+    for day, cluster_id in fingerprints:
+        clusters_by_day.setdefault(day, []).append(cluster_id)
+
+    segments = []
+    if start_time < first_day:
+        segments.append(("live", start_time, first_day - 1, cluster_ids))
+    used_snapshot = False
+    for day in sorted(clusters_by_day):
+        files = []
+        for cluster_id in sorted(clusters_by_day[day], key=_cluster_sort_key):
+            entry = manifest.get(_partition_key(day, cluster_id))
+            if not entry or entry["fingerprint"] != fingerprints[(day, cluster_id)]:
+                break
+            f = _open_partition(entry)
+            if f is None:
+                break
+            files.append(("file", entry, f))
+        if len(files) == len(clusters_by_day[day]):
+            segments.extend(files)
+            used_snapshot = True
+        else:
+            for _, _, f in files:
+                f.close()
+            segments.append(("live", day, day + DAY - 1, cluster_ids))
+    if end_of_days <= end_time:
+        segments.append(("live", end_of_days, end_time, cluster_ids))
+
+    return segments if used_snapshot else None
+
+def iter_download(segments, db: Session, gzip_encoding: bool):
+    """
+    Streams a planned download. With gzip_encoding the snapshot files are sent
+    as they are on disk; otherwise they are inflated on the way out.
+    """
+    crc = 0
+    size = 0
+
+    def live_segment(data):
+        nonlocal crc, size
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        return _deflate_segment(data) if gzip_encoding else data
+
+    try:
+        if gzip_encoding:
+            yield GZIP_HEADER
+        yield live_segment(_csv_bytes([CSV_HEADER]))
+
+        for segment in segments:
+            if segment[0] == "live":
+                _, start_time, end_time, cluster_ids = segment
+                batch = []
+                for user in fetch_partition_users(db, start_time, end_time, cluster_ids=cluster_ids):
+                    batch.append(csv_row(user))
+                    if len(batch) == 1000:
+                        yield live_segment(_csv_bytes(batch))
+                        batch = []
+                if batch:
+                    yield live_segment(_csv_bytes(batch))
+                continue
+
+            _, entry, f = segment
+            crc = crc32_combine(crc, entry["crc"], entry["size"])
+            size += entry["size"]
+            inflater = None if gzip_encoding else zlib.decompressobj(-15)
+            # ASGI has no zero-copy path, so pass the stored bytes through unchanged
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    break
+                yield block if inflater is None else inflater.decompress(block)
+            f.close()
+
+        if gzip_encoding:
+            yield DEFLATE_END + struct.pack("<II", crc, size & 0xFFFFFFFF)
+    finally:
+        # Also when the client goes away mid-download
+        for segment in segments:
+            if segment[0] == "file":
+                segment[2].close()
+
+def main():
+    """
+    Rebuilds stale snapshot partitions, optionally limited to a time range.
+    """
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Refresh CSV export snapshots")
+    parser.add_argument("--start-time", type=int, default=None)
+    parser.add_argument("--end-time", type=int, default=None)
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        rebuilt = refresh(session, args.start_time, args.end_time)
+        print(f"Rebuilt {rebuilt} snapshot partitions.")
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    main()
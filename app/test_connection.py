@@ -3,17 +3,12 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import text  # Import the text function
-from database import engine, SessionLocal, Base
-import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+from .database import get_engine, SessionLocal
 
 def test_db_connection():
     try:
         # Attempt to connect to the database
-        with engine.connect() as connection:
+        with get_engine().connect() as connection:
             print("✅ Successfully connected to the database!")
 
         # Create a new session
@@ -1,22 +1,226 @@
 # app/utils.py
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
 
-def get_logger(name=__name__):
+from .config import load_env
+
+# Set per request by RequestIdMiddleware and attached to every record logged during it
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_state_lock = threading.Lock()
+_stats = {"dropped": 0, "sampled_out": 0}
+_queue = None
+_listener = None
+_handler = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s')
+
+    def format(self, record):
+        if not hasattr(record, "request_id") or record.request_id is None:
+            record.request_id = "-"
+        return super().format(record)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the background writer. Never blocks: when the queue is
+    full the record is dropped and counted.
+    """
+
+    def prepare(self, record):
+        # Resolve the message and request id now; formatting happens on the writer thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        record.request_id = request_id_var.get()
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _state_lock:
+                _stats["dropped"] += 1
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of INFO/DEBUG records and caps them at max_per_second
+    (token bucket). Warnings and errors always pass.
+    """
+
+    def __init__(self, sample_rate=1.0, max_per_second=None):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self._tokens = max_per_second or 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return self._reject()
+        if self.max_per_second is not None:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.max_per_second,
+                    self._tokens + (now - self._updated) * self.max_per_second,
+                )
+                self._updated = now
+                if self._tokens < 1:
+                    return self._reject()
+                self._tokens -= 1
+        return True
+
+    def _reject(self):
+        with _state_lock:
+            _stats["sampled_out"] += 1
+        return False
+
+def _start_writer():
+    global _queue, _listener, _handler
+    load_env()
+    _queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT") == "text" else JsonFormatter())
+    _listener = logging.handlers.QueueListener(_queue, stream)
+    _listener.start()
+
+    if _handler is None:
+        _handler = DroppingQueueHandler(_queue)
+        _handler.setLevel(logging.INFO)
+    else:
+        _handler.queue = _queue
+
+def _ensure_writer():
+    with _state_lock:
+        if _listener is None:
+            _start_writer()
+    return _handler
+
+def _restart_writer_after_fork():
+    # The writer thread does not survive fork; give the child its own
+    global _listener, _state_lock
+    _state_lock = threading.Lock()
+    if _listener is not None:
+        _listener = None
+        _start_writer()
+
+def shutdown_logging():
+    """
+    Flushes queued records and stops the writer thread.
+    """
+    global _listener
+    with _state_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+atexit.register(shutdown_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_writer_after_fork)
+
+def log_stats():
+    with _state_lock:
+        return dict(_stats)
+
+def configure_sampling(name, sample_rate=1.0, max_per_second=None):
+    """
+    Samples and/or rate limits the INFO/DEBUG records of one logger.
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+    for existing in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+        logger.removeFilter(existing)
+    if sample_rate < 1.0 or max_per_second is not None:
+        logger.addFilter(SamplingFilter(sample_rate, max_per_second))
 
-    # Console handler
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.INFO)
+def _sampling_from_env(name):
+    # LOG_SAMPLING="app.auth=0.1/50,app.exports=0.5": rate, optionally /max per second
+    for entry in os.getenv("LOG_SAMPLING", "").split(","):
+        logger_name, _, setting = entry.strip().partition("=")
+        if logger_name != name or not setting:
+            continue
+        rate, _, per_second = setting.partition("/")
+        configure_sampling(name, float(rate), float(per_second) if per_second else None)
 
-    # Formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
+def get_logger(name=__name__):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
 
     # Add handler
     if not logger.handlers:
-        logger.addHandler(ch)
+        logger.addHandler(_ensure_writer())
+        _sampling_from_env(name)
 
     return logger
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware giving each request an id (from X-Request-ID or a new
+    one) that is echoed back and attached to log records.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if 0 < len(candidate) <= 128 and candidate.isprintable():
+                    request_id = candidate
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
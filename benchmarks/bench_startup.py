@@ -0,0 +1,64 @@
+# benchmarks/bench_startup.py
+
+"""
+Measures how long a fresh worker takes to become able to serve.
+
+Each run starts a new interpreter, imports app.main, runs the lifespan startup
+and answers /healthz, timing each phase. Run from the repository root:
+
+    python benchmarks/bench_startup.py [--runs 10]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CHILD = """
+import json, time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app.main.app) as client:
+    ready = time.perf_counter()
+    assert client.get("/healthz").status_code == 200
+    served = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "startup": ready - imported,
+    "first_request": served - ready,
+    "total": served - started,
+}))
+"""
+
+def run_once(env):
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker startup benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite://")
+    env.setdefault("SECRET_KEY", "benchmark")
+    env.setdefault("ALGORITHM", "HS256")
+    env.setdefault("ADMIN_USERNAME", "admin")
+    env.setdefault("ADMIN_PASSWORD_HASH", "unused")
+    env.setdefault("LOG_FORMAT", "text")
+
+    runs = [run_once(env) for _ in range(args.runs)]
+    for phase in ("import", "startup", "first_request", "total"):
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:>14}: median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 // src/DataPage.js
 
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import axios from 'axios';
 import {
   Container, TextField, Button, Select, InputLabel, FormControl,
@@ -20,16 +20,25 @@ function DataPage() {
   const [parameter, setParameter] = useState('');
   const [loading, setLoading] = useState(false);
   const [data, setData] = useState([]);
-  const [csvData, setCsvData] = useState([]);
+  const [feed, setFeed] = useState(null);
   const [errorMessage, setErrorMessage] = useState('');
 
+  // Process data for CSV
+  const csvData = data.map((row) => ({
+    id: row.id,
+    userId: row.userId,
+    originationTime: new Date(row.originationTime * 1000).toLocaleString(),
+    clusterId: row.clusterId,
+    phones: row.phones.map((p) => p.identifier).join('; '),
+    voicemails: row.voicemails.map((v) => v.identifier).join('; '),
+  }));
+
   const handleLogout = () => {
     localStorage.removeItem('access_token');
     navigate('/');
   };
 
-  const handleSubmit = async (event) => {
-    event.preventDefault();
+  const loadUsers = async (params) => {
     setLoading(true);
     setErrorMessage('');
 
@@ -40,12 +49,6 @@ function DataPage() {
       return;
     }
 
-    const params = {
-      start_time: Math.floor(new Date(startTime).getTime() / 1000),
-      end_time: Math.floor(new Date(endTime).getTime() / 1000),
-      parameter: parameter || null,
-    };
-
     try {
       const response = await axios.get('http://localhost:8000/users/', {
         params,
@@ -54,18 +57,8 @@ function DataPage() {
         },
       });
       setData(response.data);
-
-      // Process data for CSV
-      const processedData = response.data.map((row) => ({
-        id: row.id,
-        userId: row.userId,
-        originationTime: new Date(row.originationTime * 1000).toLocaleString(),
-        clusterId: row.clusterId,
-        phones: row.phones.map((p) => p.identifier).join('; '),
-        voicemails: row.voicemails.map((v) => v.identifier).join('; '),
-      }));
-      setCsvData(processedData);
-
+      // Subscribe to changes made after this response was built
+      setFeed({ params, version: response.headers['x-change-version'] });
     } catch (error) {
       console.error('Error fetching data:', error);
       setErrorMessage('Failed to fetch data. Please check your inputs.');
@@ -74,6 +67,80 @@ function DataPage() {
     }
   };
 
+  const handleSubmit = async (event) => {
+    event.preventDefault();
+    await loadUsers({
+      start_time: Math.floor(new Date(startTime).getTime() / 1000),
+      end_time: Math.floor(new Date(endTime).getTime() / 1000),
+      parameter: parameter || null,
+    });
+  };
+
+  // Live updates: stream only users ingested after the fetched version
+  useEffect(() => {
+    if (!feed || !feed.version) return undefined;
+
+    const accessToken = localStorage.getItem('access_token');
+    const controller = new AbortController();
+    let lastEventId = feed.version;
+
+    const handleMessage = (message) => {
+      const fields = {};
+      message.split('\n').forEach((line) => {
+        const separator = line.indexOf(': ');
+        if (separator > 0) fields[line.slice(0, separator)] = line.slice(separator + 2);
+      });
+      if (fields.id) lastEventId = fields.id;
+      if (fields.event === 'user') {
+        const user = JSON.parse(fields.data);
+        setData((rows) => [...rows.filter((row) => row.id !== user.id), user]);
+      } else if (fields.event === 'reset') {
+        // The server no longer has our version; reload the whole window
+        controller.abort();
+        loadUsers(feed.params);
+      }
+    };
+
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const query = new URLSearchParams({
+            since: lastEventId,
+            start_time: feed.params.start_time,
+            end_time: feed.params.end_time,
+          });
+          const response = await fetch(`http://localhost:8000/users/feed?${query}`, {
+            headers: { Authorization: `Bearer ${accessToken}` },
+            signal: controller.signal,
+          });
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = '';
+          for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+              handleMessage(buffer.slice(0, boundary));
+              buffer = buffer.slice(boundary + 2);
+              boundary = buffer.indexOf('\n\n');
+            }
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          console.error('Live feed disconnected:', error);
+        }
+        // Reconnect and backfill from the last event we saw
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+      }
+    };
+
+    listen();
+    return () => controller.abort();
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [feed]);
+
   return (
     <Container maxWidth="md">
       <Box mt={4}>
@@ -1,6 +1,13 @@
 # run.py
 
+import sys
+
 import uvicorn
 
 if __name__ == "__main__":
+    if "--prod" in sys.argv[1:]:
+        # Multi-worker production server; see app/server.py for its options
+        from app.server import main
+        sys.exit(main([arg for arg in sys.argv[1:] if arg != "--prod"]))
+
     uvicorn.run("app.main:app", host="127.0.0.1", port=8000, reload=True)
@@ -1,6 +1,9 @@
 import sys
 import os
+import asyncio
+import gzip
 import json
+import time
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
@@ -12,7 +15,8 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app.main import app, get_db
 from app.database import Base
-from app import models
+from app import models, exports, snapshots
+from app.changelog import ChangeLog, feed_events
 from app.auth import get_current_user
 
 # Use an in-memory SQLite database for testing
@@ -38,6 +42,9 @@ def override_get_current_user():
 app.dependency_overrides[get_db] = override_get_db
 app.dependency_overrides[get_current_user] = override_get_current_user
 
+# Background export workers open their own sessions
+exports.manager.session_factory = TestingSessionLocal
+
 client = TestClient(app)
 
 # Load test data from documents.json
@@ -172,3 +179,696 @@ def test_get_users_order_by_cluster(test_client):
     cluster_ids = [user['clusterId'] for user in data]
     cluster_ids_filtered = [cid for cid in cluster_ids if cid is not None]
     assert cluster_ids_filtered == sorted(cluster_ids_filtered)
+
+def wait_for_export(test_client, job_id):
+    for _ in range(100):
+        job = test_client.get(f"/exports/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("export did not finish")
+
+def test_export_job_matches_download(test_client, tmp_path, monkeypatch):
+    monkeypatch.setenv("EXPORT_DIR", str(tmp_path))
+    monkeypatch.setenv("EXPORT_CHUNK_SIZE", "7")
+    params = {"start_time": 0, "end_time": 9999999999, "parameter": "phone"}
+
+    response = test_client.post("/exports/", params=params)
+    assert response.status_code == 202
+    job = wait_for_export(test_client, response.json()["id"])
+    assert job["status"] == "completed"
+    assert job["rows_written"] == job["total_rows"]
+
+    exported = test_client.get(job["download_url"])
+    assert exported.status_code == 200
+    assert exported.text == test_client.get("/users/download", params=params).text
+
+    # Identical parameters reuse the finished export
+    again = test_client.post("/exports/", params=params).json()
+    assert again["id"] == job["id"]
+    assert again["status"] == "completed"
+
+    # Keyset chunks reproduce every ordering
+    monkeypatch.setenv("EXPORT_CHUNK_SIZE", "3")
+    for parameter in ("user_id", "voicemail", "cluster"):
+        other = {**params, "parameter": parameter}
+        other_job = wait_for_export(test_client, test_client.post("/exports/", params=other).json()["id"])
+        assert test_client.get(other_job["download_url"]).text == test_client.get("/users/download", params=other).text
+
+    partial = test_client.get(job["download_url"], headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == exported.content[10:20]
+
+    # A running job owned by another worker is left alone until its owner is gone
+    from app.crud import data_version
+    db = TestingSessionLocal()
+    version = data_version(0, 9999999998, db)
+    db.close()
+    params_key = exports._params_key(0, 9999999998, None, {})
+    running = exports.ExportJob(exports._job_id(params_key, version), params_key, 0, 9999999998, None, version)
+    running.status = "running"
+    running.save()
+    owner = exports._try_lock(running.lock_path)
+    other_worker = exports.ExportManager(TestingSessionLocal)
+    assert other_worker.load(running.id).status == "running"
+    assert running.id not in other_worker.jobs
+    assert not os.path.exists(running.part_path)
+    owner.close()
+    assert other_worker.load(running.id).id in other_worker.jobs
+    assert wait_for_export(test_client, running.id)["status"] == "completed"
+
+    # Finished exports past EXPORT_MAX_AGE are deleted, then the oldest while over EXPORT_MAX_BYTES
+    with open(os.path.join(tmp_path, f"{job['id']}.json")) as f:
+        meta = json.load(f)
+    meta["updated_at"] = 0
+    with open(os.path.join(tmp_path, f"{job['id']}.json"), "w") as f:
+        json.dump(meta, f)
+    assert exports.manager.prune() == 1
+    assert job["id"] not in exports.manager.jobs
+    assert test_client.get(f"/exports/{job['id']}").status_code == 404
+    assert test_client.get(f"/exports/{running.id}").json()["status"] == "completed"
+    monkeypatch.setenv("EXPORT_MAX_BYTES", "1")
+    assert exports.manager.prune() == 4
+    assert not list(tmp_path.glob("*.csv")) and not exports.manager.jobs
+
+def test_download_served_from_snapshots(test_client, tmp_path, monkeypatch):
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+    db = TestingSessionLocal()
+    try:
+        # Refreshes wait for one running elsewhere (the lock is per open file, so this acts
+        # like another process)
+        import threading
+        holder = exports.lock_file(str(tmp_path / "refresh.lock"))
+        rebuilt = []
+        refresher = threading.Thread(target=lambda: rebuilt.append(snapshots.refresh(db)))
+        refresher.start()
+        refresher.join(0.3)
+        assert refresher.is_alive() and not rebuilt
+        holder.close()
+        refresher.join(10)
+        assert rebuilt and rebuilt[0] > 0
+        # Nothing changed, so nothing is rebuilt
+        assert snapshots.refresh(db) == 0
+    finally:
+        db.close()
+
+    # An unaligned window: partial first and last days come from live queries
+    params = {"start_time": 1700000123, "end_time": 1730000456}
+    live = test_client.get("/users/download", params={**params, "parameter": "user_id"})
+    expected = sorted(live.text.splitlines()[1:])
+
+    # The default order does not depend on snapshots being there
+    default = test_client.get("/users/download", params=params).text.splitlines()[1:]
+    assert [int(line.split(",")[0]) for line in default] == sorted(int(line.split(",")[0]) for line in default)
+    assert test_client.get("/users/download", params={**params, "order": "partition", "parameter": "phone"}).status_code == 400
+
+    for encoding in ("gzip", "identity"):
+        response = test_client.get(
+            "/users/download", params={**params, "order": "partition"}, headers={"Accept-Encoding": encoding}
+        )
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding") == (encoding if encoding == "gzip" else None)
+        lines = response.text.splitlines()
+        assert lines[0] == live.text.splitlines()[0]
+        assert sorted(lines[1:]) == expected
+
+    # Without snapshots the same order is produced live
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    monkeypatch.setenv("SNAPSHOT_DIR", str(empty))
+    assert test_client.get("/users/download", params={**params, "order": "partition"}).text == response.text
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+
+    # One cluster and one whole day: id order equals partition order, so the default uses the snapshot
+    day = {"start_time": 19740 * 86400, "end_time": 19741 * 86400 - 1, "cluster_id": "domainserver2"}
+    response = test_client.get("/users/download", params=day, headers={"Accept-Encoding": "gzip"})
+    assert response.headers.get("content-encoding") == "gzip"
+    ids = [int(line.split(",")[0]) for line in response.text.splitlines()[1:]]
+    assert len(ids) == 2 and ids == sorted(ids)
+    monkeypatch.setenv("SNAPSHOT_DIR", str(empty))
+    live_day = test_client.get("/users/download", params=day, headers={"Accept-Encoding": "gzip"})
+    assert live_day.headers.get("content-encoding") is None and live_day.text == response.text
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+
+    # An in-place edit keeps every count and sum; the day's revision invalidates it
+    from app.crud import bump_revisions
+    db = TestingSessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.originationTime.between(1700086400, 1729913600)).first()
+        old_user_id, user.userId = user.userId, "999999999"
+        bump_revisions(db, [user.originationTime])
+        db.commit()
+        assert snapshots.refresh_for_times(db, [user.originationTime]) == 1
+        edited = test_client.get("/users/download", params={**params, "order": "partition"}).text
+        assert "999999999" in edited
+
+        # A download planned before a refresh keeps streaming the files it planned
+        segments = snapshots.plan_download(params["start_time"], params["end_time"], db)
+        user.userId = old_user_id
+        bump_revisions(db, [user.originationTime])
+        db.commit()
+        superseded = [s[1]["file"] for s in segments if s[0] == "file"]
+        assert snapshots.refresh_for_times(db, [user.originationTime]) == 1
+        planned = b"".join(snapshots.iter_download(segments, db, gzip_encoding=True))
+        assert gzip.decompress(planned).decode() == edited
+
+        # Superseded files are swept once their grace period is over
+        assert all((tmp_path / f).exists() for f in superseded)
+        monkeypatch.setenv("SNAPSHOT_GRACE_SECONDS", "0")
+        snapshots.refresh(db)
+        referenced = {entry["file"] for entry in snapshots.load_manifest().values()}
+        on_disk = {str(p.relative_to(tmp_path)) for p in tmp_path.glob("*/*.deflate*")}
+        assert on_disk == referenced
+    finally:
+        db.close()
+
+def test_feed_backfills_changes_after_version(test_client):
+    version = int(test_client.get("/users/", params={
+        "start_time": 0, "end_time": 9999999999
+    }).headers["X-Change-Version"])
+    assert version >= 0
+
+    log = ChangeLog(retention=3, poll_interval=0.01, gap_timeout=0.05)
+
+    def record(user_ids):
+        # Writers add entries in their own transaction, like migrate and the importer
+        db = TestingSessionLocal()
+        try:
+            log.record(db, user_ids)
+            db.commit()
+            return log.latest(db)
+        finally:
+            db.close()
+
+    start = version
+    assert record([10001, 10002]) == start + 2
+
+    async def collect(since, count):
+        db = TestingSessionLocal()
+        try:
+            events = feed_events(log, db, since, heartbeat=0.01)
+            collected = []
+            while len(collected) < count:
+                event = await events.__anext__()
+                if not event.startswith(":"):
+                    collected.append(event)
+            return collected
+        finally:
+            db.close()
+
+    ready, first, second = asyncio.run(collect(start, 3))
+    assert "event: ready" in ready
+    assert "event: user" in first and '"id":10001' in first
+    assert f"id: {start + 2}" in second and '"id":10002' in second
+
+    # Reconnecting from the last seen version only returns newer changes
+    record([10001])
+    _, again = asyncio.run(collect(start + 2, 2))
+    assert f"id: {start + 3}" in again and '"id":10001' in again
+
+    # A version that never commits (e.g. a rolled back import) is skipped after gap_timeout
+    record([10002, 10001])
+    db = TestingSessionLocal()
+    db.query(models.UserChange).filter(models.UserChange.version == start + 4).delete()
+    db.commit()
+    db.close()
+    _, after_gap = asyncio.run(collect(start + 3, 2))
+    assert f"id: {start + 5}" in after_gap and '"id":10001' in after_gap
+
+    # Versions that were trimmed from the table force the client to reload
+    _, reset = asyncio.run(collect(start, 2))
+    assert "event: reset" in reset
+
+    # Users without a cluster (e.g. from a CSV import) are still streamed
+    db = TestingSessionLocal()
+    db.add(models.User(id=990100, userId="990100", originationTime=1716466632))
+    db.commit()
+    try:
+        latest = record([990100])
+        _, orphan = asyncio.run(collect(latest - 1, 2))
+        assert '"id":990100' in orphan and '"clusterId":null' in orphan
+    finally:
+        db.query(models.User).filter(models.User.id == 990100).delete()
+        db.commit()
+        db.close()
+
+def test_feed_route_resumes_from_last_event_id(test_client):
+    from urllib.parse import urlencode
+    from app.changelog import changelog
+
+    db = TestingSessionLocal()
+    start = changelog.latest(db)
+    changelog.record(db, [10001, 10002])
+    db.commit()
+    db.close()
+
+    # TestClient buffers whole responses, so drive the endless stream over ASGI directly
+    async def read_events(params, headers, until):
+        body = asyncio.Queue()
+        disconnected = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await body.put(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/users/feed", "raw_path": b"/users/feed", "root_path": "",
+            "query_string": urlencode(params).encode(),
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            "client": ("testclient", 50000), "server": ("testserver", 80),
+        }
+        task = asyncio.create_task(app(scope, receive, send))
+        start_message = await asyncio.wait_for(body.get(), 5)
+        text, events = "", []
+        while not events or not until(events[-1]):
+            message = await asyncio.wait_for(body.get(), 5)
+            text += message.get("body", b"").decode()
+            while "\n\n" in text:
+                event, text = text.split("\n\n", 1)
+                events.append(event.split("\n"))
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        return start_message, events
+
+    # Last-Event-ID wins over `since`; 10001 is outside the time window
+    params = {"since": start + 1000, "start_time": 1716000000, "end_time": 1717000000}
+    start_message, events = asyncio.run(read_events(
+        params, {"Last-Event-ID": str(start)}, lambda event: "event: user" in event
+    ))
+    assert start_message["status"] == 200
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in start_message["headers"]
+    assert events[0][:2] == [f"id: {start}", "event: ready"]
+    assert events[1][:2] == [f"id: {start + 2}", "event: user"]
+    assert json.loads(events[1][2][len("data: "):])["id"] == 10002
+
+    # Without the header an unknown `since` forces a reload
+    _, events = asyncio.run(read_events(params, {}, lambda event: "event: reset" in event))
+    assert events[-1][1] == "event: reset"
+
+def test_get_users_filters(test_client):
+    everything = {"start_time": 0, "end_time": 9999999999}
+    all_users = test_client.get("/users/", params=everything).json()
+    phone = all_users[0]["phones"][0]["identifier"]
+    voicemail = all_users[0]["voicemails"][0]["identifier"]
+
+    response = test_client.get("/users/", params={
+        **everything, "cluster_id": ["domainserver1", "domainserver3"], "parameter": "cluster"
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data and {u["clusterId"] for u in data} == {"domainserver1", "domainserver3"}
+    assert len(data) == len([u for u in all_users if u["clusterId"] in ("domainserver1", "domainserver3")])
+
+    prefix = all_users[0]["userId"][:2]
+    data = test_client.get("/users/", params={**everything, "user_id_prefix": prefix}).json()
+    assert data == [u for u in all_users if u["userId"].startswith(prefix)]
+
+    data = test_client.get("/users/", params={**everything, "phone": phone}).json()
+    assert data == [u for u in all_users if phone in [p["identifier"] for p in u["phones"]]]
+
+    data = test_client.get("/users/", params={**everything, "voicemail_prefix": voicemail[:3]}).json()
+    assert data == [
+        u for u in all_users if any(v["identifier"].startswith(voicemail[:3]) for v in u["voicemails"])
+    ]
+
+    # LIKE wildcards in a prefix are matched literally
+    assert test_client.get("/users/", params={**everything, "phone_prefix": "%"}).json() == []
+
+def test_device_lookup_and_prefix_search(test_client):
+    with open('documents.json', 'r') as f:
+        documents = json.load(f)
+    phone_users = {}
+    for item in documents:
+        for phone in item['devices'].get('phone', []):
+            phone_users.setdefault(phone, []).append(item['_id'])
+    shared = max(phone_users, key=lambda p: len(phone_users[p]))
+
+    response = test_client.get(f"/devices/phones/{shared}/users", params={"limit": 1})
+    assert response.status_code == 200
+    page = response.json()
+    seen = [u["id"] for u in page["users"]]
+    while page["next_cursor"] is not None:
+        page = test_client.get(
+            f"/devices/phones/{shared}/users", params={"limit": 1, "cursor": page["next_cursor"]}
+        ).json()
+        seen += [u["id"] for u in page["users"]]
+    assert seen == sorted(phone_users[shared])
+
+    assert test_client.get("/devices/phones/NOPE/users").status_code == 404
+
+    prefix = shared[:3]
+    expected = sorted(p for p in phone_users if p.startswith(prefix))
+    identifiers = []
+    cursor = None
+    while True:
+        params = {"prefix": prefix, "limit": 5, "users_limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = test_client.get("/devices/phones", params=params).json()
+        for device in page["devices"]:
+            users = sorted(phone_users[device["identifier"]])
+            assert [u["id"] for u in device["users"]] == users[:2]
+            assert device["more_users"] == (len(users) > 2)
+            identifiers.append(device["identifier"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert identifiers == expected
+
+    # Users without a cluster are listed too
+    db = TestingSessionLocal()
+    phone_id = db.query(models.Phone.phoneId).filter(models.Phone.identifier == shared).scalar()
+    db.add(models.User(id=990101, userId="990101", originationTime=1716466632))
+    db.add(models.UserPhones(userId=990101, phoneId=phone_id))
+    db.commit()
+    try:
+        response = test_client.get(f"/devices/phones/{shared}/users", params={"cursor": 990100})
+        assert response.status_code == 200
+        assert response.json()["users"] == [
+            {"id": 990101, "userId": "990101", "originationTime": 1716466632, "clusterId": None}
+        ]
+        device = test_client.get("/devices/phones", params={"prefix": shared, "users_limit": 100}).json()
+        assert device["devices"][0]["users"][-1]["clusterId"] is None
+    finally:
+        db.query(models.UserPhones).filter(models.UserPhones.userId == 990101).delete()
+        db.query(models.User).filter(models.User.id == 990101).delete()
+        db.commit()
+        db.close()
+
+def test_get_users_fields_projection(test_client):
+    from sqlalchemy import event
+
+    everything = {"start_time": 0, "end_time": 9999999999}
+    full = test_client.get("/users/", params={**everything, "parameter": "phone"}).json()
+
+    statements = []
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        response = test_client.get("/users/", params={
+            **everything, "parameter": "user_id", "fields": "id,userId,clusterId"
+        })
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert response.status_code == 200
+    data = response.json()
+    assert data and all(set(user) == {"id", "userId", "clusterId"} for user in data)
+    assert [u["userId"] for u in data] == sorted(u["userId"] for u in full)
+    # No device tables and no unrequested columns in any SELECT list
+    assert not any("Phones" in s or "Voicemails" in s or "originationTime\" AS" in s for s in statements)
+
+    data = test_client.get("/users/", params={
+        **everything, "parameter": "phone", "fields": "userId,phones"
+    }).json()
+    assert data == [{"userId": u["userId"], "phones": u["phones"]} for u in full]
+
+    assert test_client.get("/users/", params={**everything, "fields": "id,password"}).status_code == 400
+
+    csv_text = test_client.get("/users/download", params={
+        **everything, "parameter": "phone", "fields": "userId,voicemails"
+    }).text
+    lines = csv_text.splitlines()
+    assert lines[0] == "UserID,Voicemails"
+    assert lines[1] == f'{full[0]["userId"]},{";".join(v["identifier"] for v in full[0]["voicemails"])}'
+
+def test_batch_windows_match_single_queries(test_client):
+    windows = [
+        {"start_time": 1700000000, "end_time": 1710000000, "parameter": "phone"},
+        {"start_time": 1705000000, "end_time": 1720000000, "parameter": "cluster"},
+        {"start_time": 1725000000, "end_time": 1730000000},
+        {"start_time": 1600000000, "end_time": 1600000100, "parameter": "user_id"},
+        {"start_time": 1690000000, "end_time": 1740000000, "parameter": "voicemail"},
+        {"start_time": 1690000000, "end_time": 1740000000, "parameter": "user_id"},
+    ]
+    response = test_client.post("/users/batch", json=windows)
+    assert response.status_code == 200
+    results = response.json()
+    assert len(results) == len(windows)
+    for window, result in zip(windows, results):
+        single = test_client.get("/users/", params=window).json()
+        assert result["users"] == single
+        assert result["start_time"] == window["start_time"]
+
+    projected = test_client.post("/users/batch", params={"fields": "id"}, json=windows[:1]).json()
+    assert projected[0]["users"] == [{"id": u["id"]} for u in results[0]["users"]]
+
+    assert test_client.post("/users/batch", json=[]).status_code == 400
+    assert test_client.post("/users/batch", json=[{"start_time": 5, "end_time": 1}]).status_code == 400
+
+def test_logging_is_queued_structured_and_never_blocks(test_client):
+    import logging
+    import queue as queue_module
+    from app import utils
+
+    response = test_client.get("/users/", params={"start_time": 0, "end_time": 1},
+                               headers={"X-Request-ID": "req-123"})
+    assert response.headers["X-Request-ID"] == "req-123"
+
+    # Records carry the request id and are rendered as JSON on the writer side
+    handler = utils.DroppingQueueHandler(queue_module.Queue(maxsize=1))
+    token = utils.request_id_var.set("req-456")
+    try:
+        record = logging.LogRecord("app.test", logging.INFO, __file__, 1, "hello %s", ("world",), None)
+        handler.handle(record)
+    finally:
+        utils.request_id_var.reset(token)
+    entry = json.loads(utils.JsonFormatter().format(handler.queue.get_nowait()))
+    assert entry["message"] == "hello world" and entry["request_id"] == "req-456"
+
+    # A full queue drops instead of blocking
+    before = utils.log_stats()["dropped"]
+    handler.handle(record)
+    handler.handle(record)
+    assert utils.log_stats()["dropped"] == before + 1
+
+    sampler = utils.SamplingFilter(sample_rate=1.0, max_per_second=2)
+    assert [sampler.filter(record) for _ in range(4)] == [True, True, False, False]
+    record.levelno = logging.ERROR
+    assert sampler.filter(record)
+
+def test_profiling_on_demand(test_client, tmp_path, monkeypatch):
+    import pstats
+    from app.profiling import ProfilingMiddleware
+
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    monkeypatch.setenv("PROFILE_TOKEN", "secret")
+    monkeypatch.setenv("PROFILE_MAX_FILES", "2")
+    profiled_client = TestClient(ProfilingMiddleware(app))
+    params = {"start_time": 0, "end_time": 9999999999, "parameter": "phone"}
+
+    # Without (or with a wrong) token nothing is recorded
+    profiled_client.get("/users/download", params=params)
+    profiled_client.get("/users/download", params=params, headers={"X-Profile-Token": "nope"})
+    assert test_client.get("/admin/profiles/").json() == []
+
+    response = profiled_client.get("/users/download", params=params, headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 200
+    profiles = test_client.get("/admin/profiles/").json()
+    assert len(profiles) == 1
+
+    downloaded = test_client.get(f"/admin/profiles/{profiles[0]['name']}")
+    assert downloaded.status_code == 200
+    path = tmp_path / "downloaded.prof"
+    path.write_bytes(downloaded.content)
+    functions = {func[2] for func in pstats.Stats(str(path)).stats}
+    assert {"fetch_users", "iter_csv", "csv_row"} <= functions
+
+    # The ring keeps only the newest PROFILE_MAX_FILES
+    for _ in range(3):
+        time.sleep(0.01)
+        profiled_client.get("/users/", params=params, headers={"X-Profile-Token": "secret"})
+    assert len(test_client.get("/admin/profiles/").json()) == 2
+    assert test_client.get("/admin/profiles/..%2Fsecret.prof").status_code == 404
+
+def test_health_and_readiness(test_client):
+    assert test_client.get("/healthz").json()["status"] == "ok"
+    assert test_client.get("/readyz").json() == {"status": "ready"}
+
+def test_import_does_not_touch_the_database():
+    import subprocess
+
+    # An unreachable database must not slow down or break importing the app
+    env = {**os.environ, "DATABASE_URL": "mysql+pymysql://nobody@127.0.0.1:1/none"}
+    code = (
+        "import app.main, app.database as d;"
+        "assert d.get_engine.cache_info().currsize == 0"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True,
+        cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    )
+    assert result.returncode == 0, result.stderr
+
+def start_prefork_server(tmp_path, *args, **env):
+    import socket
+    import subprocess
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    # A complete settings environment, whatever the developer's shell has
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{tmp_path / 'server.db'}",
+        "SECRET_KEY": "test-secret",
+        "ALGORITHM": "HS256",
+        "ADMIN_USERNAME": "admin",
+        "ADMIN_PASSWORD_HASH": "unused",
+        "LOG_FORMAT": "text",
+        **env,
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.server", "--host", "127.0.0.1", "--port", str(port),
+         "--graceful-timeout", "5", *args],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    )
+    return server, f"http://127.0.0.1:{port}"
+
+def get_when_up(url, deadline):
+    import urllib.request
+
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                return response.status, response.read()
+        except OSError:
+            time.sleep(0.1)
+    raise AssertionError(f"{url} did not answer")
+
+def stop_prefork_server(server):
+    import signal
+
+    server.send_signal(signal.SIGTERM)
+    output, _ = server.communicate(timeout=20)
+    return output
+
+def test_prefork_server_recycles_workers(tmp_path):
+    from app.server import pool_size_per_worker
+
+    assert pool_size_per_worker(100, 4) == 20
+    assert pool_size_per_worker(3, 8) == 1
+
+    server, base_url = start_prefork_server(tmp_path, "--workers", "2", "--max-requests", "2")
+    try:
+        deadline = time.time() + 20
+        # Enough requests that every worker hits its limit and is replaced
+        statuses = [get_when_up(f"{base_url}/healthz", deadline)[0] for _ in range(10)]
+        assert statuses == [200] * 10
+    finally:
+        output = stop_prefork_server(server)
+    assert server.returncode == 0, output
+    assert "Maximum request limit" in output
+
+def test_prefork_rolling_restart_keeps_workers_when_replacement_fails(tmp_path):
+    import signal
+
+    # An app whose startup fails once the marker file exists
+    (tmp_path / "flaky_app.py").write_text(
+        "import os\n"
+        "from contextlib import asynccontextmanager\n"
+        "from fastapi import FastAPI\n"
+        "@asynccontextmanager\n"
+        "async def lifespan(app):\n"
+        "    if os.path.exists(os.environ['FAIL_MARKER']):\n"
+        "        raise RuntimeError('refusing to start')\n"
+        "    yield\n"
+        "app = FastAPI(lifespan=lifespan)\n"
+        "@app.get('/pid')\n"
+        "def pid():\n"
+        "    return os.getpid()\n"
+    )
+    marker = tmp_path / "fail"
+    server, base_url = start_prefork_server(
+        tmp_path, "--app", "flaky_app:app", "--workers", "2",
+        FAIL_MARKER=str(marker), PYTHONPATH=str(tmp_path),
+    )
+    try:
+        status, _ = get_when_up(f"{base_url}/pid", time.time() + 20)
+        assert status == 200
+        marker.touch()
+        server.send_signal(signal.SIGHUP)
+        time.sleep(3)
+        # The supervisor and its current workers are still serving
+        assert server.poll() is None
+        assert get_when_up(f"{base_url}/pid", time.time() + 5)[0] == 200
+    finally:
+        output = stop_prefork_server(server)
+    assert server.returncode == 0, output
+    assert "did not start; keeping the 2 current workers" in output
+
+def test_import_csv(test_client, tmp_path, monkeypatch):
+    from app.importer import import_csv, parse_timestamp
+
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+    assert parse_timestamp("2024-05-23, 8:17:12 a.m.") == 1716466632
+    assert parse_timestamp("2024-01-01, 12:00:00 a.m.") == 1704085200
+    assert parse_timestamp("2024-01-01, 12:30:00 PM") == 1704130200
+    assert parse_timestamp("1716466632") == 1716466632
+
+    # data.csv into an empty database, in small chunks
+    import_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=import_engine)
+    db = sessionmaker(bind=import_engine)()
+    with open('data.csv', encoding='utf-8-sig', newline='') as f:
+        report = import_csv(f, db, chunk_size=7)
+    assert report["rejected"] == 0
+    assert report["users_inserted"] == report["rows_read"] == db.query(models.User).count()
+    user = db.get(models.User, 10002)
+    assert (user.userId, user.originationTime, user.clusterId) == ("203605710", 1716466632, "domainserver1")
+    assert sorted(vm.identifier for vm in user.voicemails) == ["MAIL477836", "MAIL770612"]
+
+    # Importing again updates in place
+    links = db.query(models.UserPhones).count()
+    with open('data.csv', encoding='utf-8-sig', newline='') as f:
+        report = import_csv(f, db)
+    assert (report["users_inserted"], report["users_updated"]) == (0, report["rows_read"])
+    assert db.query(models.UserPhones).count() == links
+    db.close()
+
+    # Upload through the API; bad rows are reported, the rest imported
+    content = (
+        "\ufeffID,User ID,Origination Time,Cluster ID,Phones,Voicemails\n"
+        '990001,990000001,"2024-05-23, 8:17:12 a.m.",importcluster,IMP0001; IMP0002,IMPVM1\n'
+        '990002,990000002,"not a time",importcluster,,\n'
+        '990003,990000001,"2024-05-23, 8:17:13 a.m.",importcluster,,\n'
+    ).encode("utf-8")
+    response = test_client.post("/users/import", files={"file": ("users.csv", content, "text/csv")})
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["rows_read"], result["users_inserted"], result["rejected"]) == (3, 1, 2)
+    assert [row["line"] for row in result["rejected_rows"]] == [3, 4]
+    assert result["clusters_added"] == 1 and result["phones_added"] == 2
+
+    users = test_client.get("/users/", params={"start_time": 1716466600, "end_time": 1716466700,
+                                               "cluster_id": "importcluster"}).json()
+    assert [(u["id"], [p["identifier"] for p in u["phones"]]) for u in users] == [(990001, ["IMP0001", "IMP0002"])]
+
+    # Update in place (the last of two rows for the ID wins), then download the day again
+    day = {"start_time": 1716422400, "end_time": 1716508799, "order": "partition"}
+    assert "990000001" in test_client.get("/users/download", params=day).text
+    content = (
+        "ID,User ID,Origination Time,Cluster ID,Phones,Voicemails\n"
+        '990001,990000008,"2024-05-23, 8:17:12 a.m.",importcluster,IMP0009,IMPVM1\n'
+        '990001,990000009,"2024-05-23, 8:17:12 a.m.",importcluster,IMP0003; IMP0004,IMPVM1\n'
+    ).encode("utf-8")
+    result = test_client.post("/users/import", files={"file": ("users.csv", content, "text/csv")}).json()
+    assert (result["rows_read"], result["users_updated"], result["rejected"]) == (2, 1, 1)
+    assert result["rejected_rows"] == [{"line": 2, "error": "Superseded by line 3"}]
+    downloaded = test_client.get("/users/download", params=day).text
+    # Same counts and sums as before, so only the day's revision reveals the change
+    assert "990001,990000009,1716466632,importcluster,IMP0003;IMP0004,IMPVM1" in downloaded.splitlines()
+    assert "990000001" not in downloaded
+
+    response = test_client.post("/users/import", files={"file": ("bad.csv", b"a,b\n1,2\n", "text/csv")})
+    assert response.status_code == 400